@@ -1,24 +1,32 @@
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 from dotenv import load_dotenv
 
-from processor import process_all_documents
+from ingest import add_documents, remove_document, list_documents, document_stats
+from sessions import touch, delete_session, maybe_reap, disk_usage
 from rag import (
-    get_text_chunks,
-    get_vectorstore,
     get_conversation_chain,
-    clear_chroma_collection,
     generate_followup_questions,
     summarize_documents,
     process_query_with_hybrid_search,
     
 )
+from models import warm_up_models
+from tracing import span, read_spans, stage_summary
 from htmlTemplates import css, bot_template, user_template
 
 
 MAX_CONVERSATION_PAIRS=5  # Keep last 5 Q&A pairs(10 items)to prevent memory bloat
 
 
+@st.cache_resource(show_spinner="Loading models...")
+def load_models():
+    # Runs once per server process, every session after that shares the loaded models
+    return warm_up_models(use_gpu=True)
+
+
 def display_chat_history():
     for msg in st.session_state.messages:
         template = user_template if msg["role"] == "user" else bot_template
@@ -39,11 +47,111 @@ def show_sources(sources):
                 f"<div class='source-box'>{doc.page_content[:1500]}</div>",
                 unsafe_allow_html=True
             )
-            if doc.metadata:
-                metadata_text = " || ".join([f"**{k}**: {v}" for k, v in doc.metadata.items()])
+            shown = {k: v for k, v in doc.metadata.items() if k in ("source", "page", "file_type")}   # ids/hashes are noise here
+            if shown:
+                metadata_text = " || ".join([f"**{k}**: {v}" for k, v in shown.items()])
                 st.caption(metadata_text)
 
 
+@st.cache_resource
+def get_background_executor():
+    # Shared by all sessions, survives script reruns
+    return ThreadPoolExecutor(max_workers=4)
+
+
+def show_followup_questions():
+    future = st.session_state.followup_future
+    if future is not None and future.done():
+        try:
+            st.session_state.followup_questions = future.result()
+        except Exception as e:
+            print(f"Error generating follow-up questions: {e}")
+        st.session_state.followup_future = None
+        st.rerun()   # full run re-registers this fragment without run_every, so the polling stops
+
+    if st.session_state.followup_questions:
+        st.divider()
+        st.markdown("**Suggested Follow Up Questions:**")
+        for q in st.session_state.followup_questions:
+            if st.button(q, use_container_width=True, key=f"followup_{q}"):
+                st.session_state.pending_query = q   # answered at the chat position on the next run
+                st.rerun()
+    elif future is not None:
+        st.caption("Generating follow-up questions...")
+
+
+def stream_answer(token_stream, start_time):
+    # Render tokens into the bot bubble as they arrive, returns the full answer and time to first token
+    placeholder = st.empty()
+    parts = []
+    ttft = None
+    for token in token_stream:
+        if ttft is None:
+            ttft = time.perf_counter() - start_time
+        parts.append(token)
+        placeholder.markdown(bot_template.replace("{{MSG}}", "".join(parts) + " ▌"), unsafe_allow_html=True)
+    answer = "".join(parts)
+    placeholder.markdown(bot_template.replace("{{MSG}}", answer), unsafe_allow_html=True)
+    return answer, ttft
+
+
+def run_query(query):
+    st.session_state.messages.append({"role": "user", "content": query})
+    st.session_state.chat_history.append(query)
+    st.markdown(user_template.replace("{{MSG}}", query), unsafe_allow_html=True)
+
+    chat_pairs = [
+        (st.session_state.chat_history[i],
+         st.session_state.chat_history[i + 1])
+        for i in range(0, len(st.session_state.chat_history) - 1, 2)
+    ]
+
+    start_time = time.perf_counter()
+    ttft = None
+    if st.session_state.use_hybrid_search:
+        with st.spinner("Processing query..."):
+            response = process_query_with_hybrid_search(
+                query=query,
+                chat_history=chat_pairs,
+                vectorstore=st.session_state.vectorstore,
+                session_id=st.session_state.session_id,
+                use_reranking=st.session_state.use_reranking,
+                stream=True,
+                filters=st.session_state.search_filters
+            )
+        if "answer_stream" in response:
+            answer, ttft = stream_answer(response["answer_stream"], start_time)
+        else:   # served from the answer cache
+            answer = response["answer"]
+            ttft = time.perf_counter() - start_time
+            st.markdown(bot_template.replace("{{MSG}}", answer), unsafe_allow_html=True)
+        st.session_state.sub_queries = response.get("sub_queries")
+    else:
+        with st.spinner("Processing query..."), span("query.chain", query_chars=len(query)) as s:
+            response = st.session_state.conversation.invoke({
+                "question": query,
+                "chat_history": chat_pairs
+            })
+            s.set(response_chars=len(response["answer"]))
+        answer = response["answer"]
+        st.session_state.sub_queries = None
+
+    total = time.perf_counter() - start_time
+    st.session_state.last_latency = {"ttft": ttft, "total": total, "cached": response.get("cached", False)}
+    print(f"Answer latency: first token {ttft if ttft is not None else total:.2f}s, total {total:.2f}s")
+
+    st.session_state.chat_history.append(answer)
+    st.session_state.messages.append({"role": "assistant", "content": answer})
+    st.session_state.sources = response.get("source_documents", [])   # sources attached once the answer is complete
+    st.session_state.last_answer = answer
+    # Suggestions are generated in the background, the answer never waits for them
+    st.session_state.followup_questions = []
+    st.session_state.followup_future = get_background_executor().submit(generate_followup_questions, query, answer)
+    max_items = MAX_CONVERSATION_PAIRS * 2
+    if len(st.session_state.chat_history) > max_items:
+        st.session_state.chat_history = st.session_state.chat_history[-max_items:]
+
+
 def main():
     load_dotenv()
 
@@ -56,6 +164,8 @@ def main():
 
     st.markdown(css, unsafe_allow_html=True)
 
+    model_load_stats = load_models()
+
     # Session State
     if "session_id" not in st.session_state:
         st.session_state.session_id = str(uuid.uuid4()) 
@@ -75,18 +185,25 @@ def main():
         st.session_state.followup_questions = []
     if "doc_summary" not in st.session_state:
         st.session_state.doc_summary = ""
-    if "raw_text" not in st.session_state:
-        st.session_state.raw_text = ""
     if "vectorstore" not in st.session_state:
         st.session_state.vectorstore = None
-    if "text_chunks" not in st.session_state:
-        st.session_state.text_chunks = []
     if "sub_queries" not in st.session_state:
         st.session_state.sub_queries = None
     if "use_hybrid_search" not in st.session_state:
         st.session_state.use_hybrid_search = True
     if "use_reranking" not in st.session_state:
         st.session_state.use_reranking = True
+    if "pending_query" not in st.session_state:
+        st.session_state.pending_query = None
+    if "last_latency" not in st.session_state:
+        st.session_state.last_latency = None
+    if "followup_future" not in st.session_state:
+        st.session_state.followup_future = None
+    if "search_filters" not in st.session_state:
+        st.session_state.search_filters = None
+
+    touch(st.session_state.session_id)   # closed tabs stop touching, their sessions get reaped after the TTL
+    maybe_reap()
 
     # Header
     st.markdown(
@@ -105,7 +222,7 @@ def main():
         st.markdown("<div class='sidebar-section-title'>Document Management</div>", unsafe_allow_html=True)
 
         if st.button("New Session", use_container_width=True, key="new_chat_btn",help="Make new session for fresh start"):
-            clear_chroma_collection(st.session_state.session_id, use_gpu=True)
+            delete_session(st.session_state.session_id)
             st.session_state.session_id = str(uuid.uuid4())
             st.session_state.messages.clear()
             st.session_state.chat_history.clear()
@@ -114,11 +231,12 @@ def main():
             st.session_state.conversation = None
             st.session_state.doc_stats = {"total_chunks": 0, "doc_count": 0, "docs_by_type": {}}
             st.session_state.followup_questions = []
+            st.session_state.followup_future = None
             st.session_state.doc_summary = ""
-            st.session_state.raw_text = ""
             st.session_state.vectorstore = None
-            st.session_state.text_chunks = []
             st.session_state.sub_queries = None
+            st.session_state.last_latency = None
+            st.session_state.search_filters = None
             st.rerun()
 
         st.divider()
@@ -134,6 +252,22 @@ def main():
                 value=True,
                 help="Reorders results by relevance using cross-encoder"
             )
+            for model_name, stats in model_load_stats.items():
+                memory = f", {stats['memory_mb']} MB" if stats["memory_mb"] is not None else ""
+                st.caption(f"{model_name}: loaded in {stats['load_seconds']}s{memory}")
+            if st.checkbox("Pipeline traces", value=False, help="Per-stage timings from the trace log"):
+                spans = read_spans()
+                st.dataframe(stage_summary(spans), hide_index=True, use_container_width=True)
+                if spans:
+                    last_trace = spans[-1]["trace_id"]
+                    st.caption("Latest trace")
+                    st.dataframe([{"stage": s["name"], "ms": s["duration_ms"], "rss_delta_mb": s["rss_delta_mb"]}
+                                  for s in spans if s["trace_id"] == last_trace], hide_index=True, use_container_width=True)
+            if st.button("Disk usage", use_container_width=True):
+                usage = disk_usage()
+                mine = usage["sessions"].get(f"session_{st.session_state.session_id}", {"vector_bytes": 0, "chunks": 0})
+                st.caption(f"This session: {mine['chunks']} chunks, {mine['vector_bytes'] / 1e6:.1f} MB of vectors on disk")
+                st.caption(f"All sessions: {len(usage['sessions'])}, {usage['total_bytes'] / 1e6:.1f} MB in total")
 
         st.divider()
 
@@ -156,6 +290,36 @@ def main():
                 st.markdown("**Document Types:**")
                 for doc_type, count in st.session_state.doc_stats["docs_by_type"].items():
                     st.caption(f"{doc_type}: {count}")
+
+            indexed_docs = list_documents(st.session_state.session_id)
+            with st.expander("Indexed documents", expanded=False):
+                for doc in indexed_docs:
+                    col1, col2 = st.columns([4, 1])
+                    with col1:
+                        st.caption(f"{doc['name']} ({doc['chunks']} chunks)")
+                    with col2:
+                        if st.button("✕", key=f"remove_{doc['file_hash']}", help="Remove this document from the session"):
+                            remove_document(st.session_state.vectorstore, st.session_state.session_id, doc["file_hash"])
+                            st.session_state.doc_stats = document_stats(st.session_state.session_id)
+                            if st.session_state.doc_stats["doc_count"] == 0:
+                                st.session_state.conversation = None
+                            st.rerun()
+
+            with st.expander("Search scope", expanded=False):
+                # Narrows both the vector and keyword search, leave everything empty to search all documents
+                doc_names = {doc["file_hash"]: doc["name"] for doc in indexed_docs}
+                selected_docs = st.multiselect("Documents", list(doc_names), format_func=doc_names.get)
+                selected_types = st.multiselect("File types", list(st.session_state.doc_stats["docs_by_type"]))
+                page_range = None
+                if st.checkbox("Limit page / slide range", help="Only PDF pages and PPTX slides have page numbers"):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        first_page = st.number_input("From", min_value=1, value=1, step=1)
+                    with col2:
+                        last_page = st.number_input("To", min_value=1, value=max(int(first_page), 10), step=1)
+                    page_range = (int(first_page), int(last_page))
+                filters = {"file_hashes": selected_docs, "file_types": selected_types, "page_range": page_range}
+                st.session_state.search_filters = {k: v for k, v in filters.items() if v} or None
             
             st.divider()
 
@@ -194,49 +358,28 @@ def main():
 
         if st.button("Process Documents", use_container_width=True):
             with st.spinner("Processing documents..."):
-                text = process_all_documents(
+                # Only files not already in this session's collection are extracted and embedded
+                vs, result = add_documents(
+                    st.session_state.vectorstore, st.session_state.session_id,
                     pdf_docs, docx_docs, pptx_docs,
                     html_docs, txt_docs, image_docs,
-                    enable_ocr, ""
+                    enable_ocr, "", use_gpu=True
                 )
+                if vs is not st.session_state.vectorstore:
+                    st.session_state.conversation = None   # index was created or moved to chroma, chain must follow it
+                st.session_state.vectorstore = vs
+                st.session_state.doc_stats = document_stats(st.session_state.session_id)
 
-                if not text.strip():
+                if st.session_state.doc_stats["doc_count"] == 0:
                     st.error("No text extracted")
                     return
 
-                chunks = get_text_chunks(text)
-                vs = get_vectorstore(chunks, st.session_state.session_id, use_gpu=True)
-                st.session_state.vectorstore = vs
-                st.session_state.text_chunks = chunks
-                st.session_state.conversation = get_conversation_chain(vs, chunks)
-                
-
-
-                doc_count = sum([
-                    len(pdf_docs) if pdf_docs else 0,
-                    len(docx_docs) if docx_docs else 0,
-                    len(pptx_docs) if pptx_docs else 0,
-                    len(html_docs) if html_docs else 0,
-                    len(txt_docs) if txt_docs else 0,
-                    len(image_docs) if image_docs else 0
-                ])
-                
-                st.session_state.doc_stats["total_chunks"] = len(chunks)
-                st.session_state.doc_stats["doc_count"] = doc_count
-                st.session_state.doc_stats["docs_by_type"] = {
-                    "PDF": len(pdf_docs) if pdf_docs else 0,
-                    "DOCX": len(docx_docs) if docx_docs else 0,
-                    "PPTX": len(pptx_docs) if pptx_docs else 0,
-                    "HTML": len(html_docs) if html_docs else 0,
-                    "TXT/MD": len(txt_docs) if txt_docs else 0,
-                    "Images": len(image_docs) if image_docs else 0
-                }
-                st.session_state.doc_stats["docs_by_type"] = {
-                    k: v for k, v in st.session_state.doc_stats["docs_by_type"].items() if v > 0
-                }
-                
-                st.session_state.raw_text = text
-                st.success("Documents processed successfully")
+                if st.session_state.conversation is None:
+                    st.session_state.conversation = get_conversation_chain(vs, st.session_state.session_id)
+
+                st.success(f"Documents processed successfully ({len(result['added'])} new, "
+                           f"{result['already_indexed']} already indexed, "
+                           f"{result['duplicates']} duplicate chunks skipped)")
                 st.rerun()
 
     # Chat 
@@ -244,48 +387,17 @@ def main():
 
     # Main flow logic
     if prompt := st.chat_input("Ask something about your documents..."):
+        st.session_state.pending_query = prompt
+
+    if st.session_state.pending_query:
+        query = st.session_state.pending_query
+        st.session_state.pending_query = None
 
         if not st.session_state.conversation:
             st.warning("Please upload and process documents first")
             st.stop()
 
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        st.session_state.chat_history.append(prompt)
-
-        chat_pairs = [
-            (st.session_state.chat_history[i],
-             st.session_state.chat_history[i + 1])
-            for i in range(0, len(st.session_state.chat_history) - 1, 2)
-        ]
-
-        with st.spinner("Processing query..."):
-            if st.session_state.use_hybrid_search:
-                response = process_query_with_hybrid_search(
-                    conversation_chain=st.session_state.conversation,
-                    query=prompt,
-                    chat_history=chat_pairs,
-                    vectorstore=st.session_state.vectorstore,
-                    text_chunks=st.session_state.text_chunks,
-                    use_reranking=st.session_state.use_reranking
-                )
-                st.session_state.sub_queries = response.get("sub_queries")
-            else:
-                response = st.session_state.conversation.invoke({
-                    "question": prompt,
-                    "chat_history": chat_pairs
-                })
-                st.session_state.sub_queries = None
-
-        answer = response["answer"]
-        st.session_state.chat_history.append(answer)
-        st.session_state.messages.append({"role": "assistant", "content": answer})
-        st.session_state.sources = response.get("source_documents", [])
-        st.session_state.last_answer = answer
-        st.session_state.followup_questions = generate_followup_questions(prompt, answer)
-        max_items = MAX_CONVERSATION_PAIRS * 2
-        if len(st.session_state.chat_history) > max_items:
-            st.session_state.chat_history = st.session_state.chat_history[-max_items:]
-
+        run_query(query)
         st.rerun()
 
     # Query Decompo..
@@ -296,45 +408,14 @@ def main():
                 st.markdown(f"{i}. {sq}")
 
     #follow up
-    if st.session_state.followup_questions:
-        st.divider()
-        st.markdown("**Suggested Follow Up Questions:**")
-        for q in st.session_state.followup_questions:
-            if st.button(q, use_container_width=True, key=f"followup_{q}"):
-                st.session_state.chat_history.append(q)
-                st.session_state.messages.append({"role": "user", "content": q})
-                
-                chat_pairs = [
-                    (st.session_state.chat_history[i], st.session_state.chat_history[i + 1])
-                    for i in range(0, len(st.session_state.chat_history) - 1, 2)
-                ]
-                
-                if st.session_state.use_hybrid_search:
-                    response = process_query_with_hybrid_search(
-                        conversation_chain=st.session_state.conversation,
-                        query=q,
-                        chat_history=chat_pairs,
-                        vectorstore=st.session_state.vectorstore,
-                        text_chunks=st.session_state.text_chunks,
-                        use_reranking=st.session_state.use_reranking
-                    )
-                else:
-                    response = st.session_state.conversation.invoke({
-                        "question": q,
-                        "chat_history": chat_pairs
-                    })
-                
-                answer = response["answer"]
-                st.session_state.chat_history.append(answer)
-                st.session_state.messages.append({"role": "assistant", "content": answer})
-                st.session_state.sources = response.get("source_documents", [])
-                st.session_state.last_answer = answer
-                st.session_state.followup_questions = generate_followup_questions(q, answer)
-                max_items=MAX_CONVERSATION_PAIRS * 2
-                if len(st.session_state.chat_history) > max_items:
-                    st.session_state.chat_history = st.session_state.chat_history[-max_items:]
-                
-                st.rerun()
+    pending = st.session_state.followup_future is not None
+    st.fragment(show_followup_questions, run_every=1 if pending else None)()   # polls only while suggestions are on their way
+
+    if st.session_state.last_latency:
+        latency = st.session_state.last_latency
+        first_token = f"first token {latency['ttft']:.2f}s · " if latency.get("ttft") is not None else ""
+        cached = " · from answer cache" if latency.get("cached") else ""
+        st.caption(f"{first_token}total {latency['total']:.2f}s{cached}")
 
     show_sources(st.session_state.sources)
 
@@ -0,0 +1,377 @@
+# Offline benchmark for the ingestion and query pipeline.
+#
+# Builds a synthetic corpus (text PDFs, DOCX, PPTX, HTML, images with text), times every stage against a
+# deterministic fake chat model instead of Gemini and reports p50/p95 latency and throughput per stage as JSON.
+#
+#     python benchmark.py --output bench.json
+#     python benchmark.py --output new.json --baseline bench.json   # exit code 1 on regressions
+#
+# Everything (chroma, keyword index, caches, trace log) lives in a temporary work dir, the app's data is
+# never touched. The embedding and reranker models still have to be available locally.
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+
+
+TOPICS = ["revenue", "onboarding", "security", "latency", "compliance", "inventory", "pricing", "hiring",
+          "backups", "encryption", "forecast", "support", "migration", "warranty", "logistics", "training"]
+WORDS = ["the", "team", "reported", "quarterly", "policy", "system", "customer", "process", "review", "update",
+         "increase", "region", "approval", "budget", "schedule", "incident", "service", "target", "metric", "plan",
+         "document", "release", "vendor", "contract", "audit", "risk", "owner", "deadline", "project", "result"]
+
+
+# Synthetic corpus
+
+def _sentence(rng, topic):
+    words = rng.sample(WORDS, rng.randint(8, 14))
+    words.insert(rng.randint(0, len(words)), topic)
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraphs(rng, count):
+    paragraphs = []
+    for _ in range(count):
+        topic = rng.choice(TOPICS)
+        paragraphs.append(" ".join(_sentence(rng, topic) for _ in range(rng.randint(3, 6))))
+    return paragraphs
+
+
+def _wrap(text, width=90):
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}".strip()
+    if line:
+        lines.append(line)
+    return lines
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages):
+    # Minimal text PDF (Helvetica, one content stream per page), enough for pdfplumber / PyPDF2
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for lines in pages:
+        stream = "BT /F1 10 Tf 12 TL 50 790 Td " + " ".join(f"({_pdf_escape(l)}) '" for l in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode("latin-1"))
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+                       f"/Contents {len(objects)} 0 R >>".encode())
+        kids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] /Count {len(kids)} >>".encode()
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(f"{i} 0 obj\n".encode() + obj + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+def make_docx(paragraphs):
+    from docx import Document
+    doc = Document()
+    for paragraph in paragraphs:
+        doc.add_paragraph(paragraph)
+    out = io.BytesIO()
+    doc.save(out)
+    return out.getvalue()
+
+
+def make_pptx(slides):
+    from pptx import Presentation
+    from pptx.util import Inches
+    deck = Presentation()
+    for title, body in slides:
+        slide = deck.slides.add_slide(deck.slide_layouts[5])
+        slide.shapes.title.text = title
+        slide.shapes.add_textbox(Inches(0.5), Inches(1.5), Inches(9), Inches(5)).text_frame.text = body
+    out = io.BytesIO()
+    deck.save(out)
+    return out.getvalue()
+
+
+def make_html(title, paragraphs):
+    body = "".join(f"<p>{p}</p>" for p in paragraphs)
+    return f"<html><head><title>{title}</title></head><body><h1>{title}</h1>{body}</body></html>".encode()
+
+
+def make_image(lines):
+    from PIL import Image, ImageDraw
+    image = Image.new("RGB", (1000, 40 + 24 * len(lines)), "white")
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((20, 20 + 24 * i), line, fill="black")
+    out = io.BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+class Upload(io.BytesIO):
+    # Stands in for streamlit's UploadedFile
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def build_corpus(files_per_type: int, pages: int, seed: int):
+    # {"pdf": [Upload, ...], ...} in the argument order of process_all_documents
+    rng = random.Random(seed)
+    corpus = {kind: [] for kind in ("pdf", "docx", "pptx", "html", "txt", "image")}
+    for n in range(files_per_type):
+        page_paragraphs = [_paragraphs(rng, 4) for _ in range(pages)]
+        corpus["pdf"].append(Upload(f"report_{n}.pdf", make_pdf(
+            [[l for p in paragraphs for l in _wrap(p)] for paragraphs in page_paragraphs])))
+        corpus["docx"].append(Upload(f"memo_{n}.docx", make_docx(_paragraphs(rng, 4 * pages))))
+        corpus["pptx"].append(Upload(f"deck_{n}.pptx", make_pptx(
+            [(f"{rng.choice(TOPICS).title()} update", " ".join(_paragraphs(rng, 1))) for _ in range(pages)])))
+        corpus["html"].append(Upload(f"page_{n}.html", make_html(f"Notes {n}", _paragraphs(rng, 2 * pages))))
+        corpus["txt"].append(Upload(f"notes_{n}.txt", "\n\n".join(_paragraphs(rng, 2 * pages)).encode()))
+        corpus["image"].append(Upload(f"scan_{n}.png", make_image(_wrap(" ".join(_paragraphs(rng, 1)), 70))))
+    return corpus
+
+
+def build_queries(count: int, seed: int):
+    rng = random.Random(seed + 1)
+    queries = [f"What does the {rng.choice(WORDS)} say about {rng.choice(TOPICS)}?" for _ in range(count)]
+    # one long multi-part question so decomposition and the sub-query path are measured too
+    a, b = rng.sample(TOPICS, 2)
+    queries.append(f"How did the {a} process change this quarter and also what was decided about {b}?")
+    return queries
+
+
+# Offline chat model
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeChatModel:
+    # Deterministic stand-in for ChatGoogleGenerativeAI: same prompt, same answer, optional fixed latency.
+    # Only what rag.py uses: invoke(prompt).content and stream(prompt)
+
+    def __init__(self, latency_ms: float = 0.0, **kwargs):
+        self.latency = latency_ms / 1000
+
+    def _respond(self, prompt: str) -> str:
+        if "sub-questions" in prompt:
+            question = prompt.split("Original Question:", 1)[1].split("\n", 1)[0].strip()
+            parts = [p.strip(" ?") for p in question.replace(" and also ", " and ").split(" and ") if p.strip()]
+            return "\n".join(f"{i}. {p}?" for i, p in enumerate(parts, 1))
+        if "follow-up questions" in prompt:
+            return "1. What changed since last quarter?\n2. Who owns this?\n3. What are the next steps?"
+        context = prompt.split("Context:", 1)[-1]
+        return " ".join(context.split()[:120])
+
+    def invoke(self, prompt):
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeMessage(self._respond(str(prompt)))
+
+    def stream(self, prompt):
+        words = self.invoke(prompt).content.split(" ")
+        for i, word in enumerate(words):
+            yield FakeMessage(word if i == 0 else " " + word)
+
+
+# Measurement
+
+def summarize(samples, items):
+    values = np.array(samples) * 1000
+    total_seconds = sum(samples)
+    return {
+        "samples": len(samples),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "mean_ms": round(float(values.mean()), 2),
+        "items": items,
+        "items_per_s": round(items / total_seconds, 2) if total_seconds else None,
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def isolate_stores(workdir):
+    # Must run before rag / ingest / cache are imported, they read these at import time
+    os.environ.update({
+        "CHROMA_DIR": os.path.join(workdir, "chroma_db"),
+        "LEXICAL_DB_PATH": os.path.join(workdir, "chroma_db", "lexical.sqlite"),
+        "MANIFEST_DB_PATH": os.path.join(workdir, "chroma_db", "manifest.sqlite"),
+        "DEDUPE_DB_PATH": os.path.join(workdir, "chroma_db", "dedupe.sqlite"),
+        "SESSIONS_DB_PATH": os.path.join(workdir, "chroma_db", "sessions.sqlite"),
+        "SMARTBOT_CACHE_DIR": os.path.join(workdir, "cache"),
+        "TRACE_LOG_PATH": os.path.join(workdir, "trace.jsonl"),
+    })
+
+
+def run(args):
+    # Imported only after the work dir env vars are set, the modules read them at import time
+    import rag
+    from processor import process_all_documents
+    from rag import get_text_chunks, get_vectorstore, create_hybrid_retriever, process_query_with_hybrid_search
+    from reranker import rerank_documents, score_cache
+    from cache import get_extraction_cache, get_embedding_cache, answer_cache
+    from models import warm_up_models
+    from sessions import delete_session
+
+    rag.get_llm = lambda temperature=0.3, **kwargs: FakeChatModel(args.llm_latency_ms)
+    warm_up_models(use_gpu=not args.cpu)   # model loading is not part of any stage
+
+    corpus = build_corpus(args.files, args.pages, args.seed)
+    queries = build_queries(args.queries, args.seed)
+    uploads = [corpus[kind] for kind in ("pdf", "docx", "pptx", "html", "txt", "image")]
+    corpus_bytes = sum(len(u.getvalue()) for files in uploads for u in files)
+    file_count = sum(len(files) for files in uploads)
+
+    samples = {stage: [] for stage in ("process_all_documents", "get_text_chunks", "get_vectorstore",
+                                       "create_hybrid_retriever", "rerank_documents",
+                                       "process_query_with_hybrid_search")}
+    items = {stage: 0 for stage in samples}
+
+    for repeat in range(args.repeats):
+        if not args.warm:
+            get_extraction_cache().clear()
+            get_embedding_cache().clear()
+            score_cache.clear()
+        session_id = f"bench-{repeat}"
+
+        text, seconds = timed(process_all_documents, *uploads, args.ocr, "")
+        samples["process_all_documents"].append(seconds)
+        items["process_all_documents"] += file_count
+
+        chunks, seconds = timed(get_text_chunks, text)
+        samples["get_text_chunks"].append(seconds)
+        items["get_text_chunks"] += len(chunks)
+
+        vectorstore, seconds = timed(get_vectorstore, chunks, session_id, not args.cpu)
+        samples["get_vectorstore"].append(seconds)
+        items["get_vectorstore"] += len(chunks)
+
+        for query in queries:
+            def retrieve():
+                return create_hybrid_retriever(vectorstore, session_id, k=8).invoke(query)
+            docs, seconds = timed(retrieve)
+            samples["create_hybrid_retriever"].append(seconds)
+            items["create_hybrid_retriever"] += 1
+
+            _, seconds = timed(rerank_documents, docs, query, 5)
+            samples["rerank_documents"].append(seconds)
+            items["rerank_documents"] += 1
+
+            answer_cache.invalidate(f"session_{session_id}")   # measure the pipeline, not the answer cache
+            _, seconds = timed(process_query_with_hybrid_search, query, [], vectorstore, session_id)
+            samples["process_query_with_hybrid_search"].append(seconds)
+            items["process_query_with_hybrid_search"] += 1
+
+        delete_session(session_id)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        "meta": {
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "files": file_count,
+            "corpus_mb": round(corpus_bytes / 1e6, 2),
+            "queries": len(queries),
+            "repeats": args.repeats,
+            "warm_caches": args.warm,
+            "ocr": args.ocr,
+            "llm_latency_ms": args.llm_latency_ms,
+            "seed": args.seed,
+        },
+        "stages": {stage: summarize(values, items[stage]) for stage, values in samples.items()},
+    }
+
+
+def compare(report, baseline, tolerance):
+    # Stages whose p50 got slower than baseline * (1 + tolerance)
+    regressions = []
+    print(f"\n{'stage':36} {'baseline p50':>14} {'p50':>10} {'change':>8}")
+    for stage, stats in report["stages"].items():
+        old = baseline.get("stages", {}).get(stage)
+        if not old:
+            print(f"{stage:36} {'-':>14} {stats['p50_ms']:>10} {'new':>8}")
+            continue
+        change = stats["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        flag = "  REGRESSION" if change > tolerance else ""
+        print(f"{stage:36} {old['p50_ms']:>14} {stats['p50_ms']:>10} {change:>+8.0%}{flag}")
+        if change > tolerance:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SmartBot pipeline offline")
+    parser.add_argument("--files", type=int, default=3, help="synthetic files per type")
+    parser.add_argument("--pages", type=int, default=5, help="pages / slides / sections per file")
+    parser.add_argument("--queries", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=13)
+    parser.add_argument("--ocr", action="store_true", help="enable OCR for PDFs (images are always OCR'd)")
+    parser.add_argument("--warm", action="store_true", help="keep extraction/embedding caches between repeats")
+    parser.add_argument("--cpu", action="store_true", help="don't use the GPU")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="simulated latency per fake LLM call")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p50 slowdown before failing")
+    parser.add_argument("--workdir", help="where the benchmark's stores go (default: a temp dir, removed after)")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="smartbot-bench-")
+    isolate_stores(workdir)
+    try:
+        report = run(args)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nRegressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
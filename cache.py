@@ -0,0 +1,301 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from embed_pool import iter_embeddings
+
+
+CACHE_DIR = os.getenv("SMARTBOT_CACHE_DIR", "./cache")
+EXTRACTION_CACHE_MAX_MB = float(os.getenv("EXTRACTION_CACHE_MAX_MB", "512"))
+EMBEDDING_CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024"))   # ~1.5KB per 384-dim vector
+
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))   # cosine similarity needed for a hit
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+
+EXTRACTOR_VERSION = "2"   # bump when extraction output changes so old entries stop matching
+
+
+def content_hash(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        h.update(part)
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class DiskCache:
+    # Size bounded LRU on top of sqlite, shared by every process/session using the same file.
+    # Hit/miss counters live in the db too so worker processes count towards the same numbers.
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():   # never reuse a connection inherited through fork
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+            # Total size is kept up to date by triggers, so writes never have to SUM over the whole table.
+            # recursive_triggers makes the delete half of INSERT OR REPLACE fire too
+            conn.execute("PRAGMA recursive_triggers = ON")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS entries_added AFTER INSERT ON entries BEGIN
+                                UPDATE counters SET value = value + NEW.size WHERE name = 'bytes'; END""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS entries_removed AFTER DELETE ON entries BEGIN
+                                UPDATE counters SET value = value - OLD.size WHERE name = 'bytes'; END""")
+            if conn.execute("SELECT 1 FROM counters WHERE name = 'bytes'").fetchone() is None:   # cache from before the counter
+                conn.execute("INSERT INTO counters SELECT 'bytes', COALESCE(SUM(size), 0) FROM entries")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str):
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'misses'")
+                else:
+                    conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+                    conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'hits'")
+                conn.commit()
+                return row[0] if row else None
+            except sqlite3.Error as e:
+                print(f"Cache read error ({self.path}): {e}")
+                return None
+
+    def get_many(self, keys) -> dict:
+        # One transaction for a whole batch, committing per key is what makes sqlite slow
+        found = {}
+        with self._lock:
+            try:
+                conn = self._connect()
+                unique = list(dict.fromkeys(keys))
+                for start in range(0, len(unique), 500):   # stay under sqlite's host parameter limit
+                    batch = unique[start:start + 500]
+                    marks = ",".join("?" * len(batch))
+                    found.update(conn.execute(f"SELECT key, value FROM entries WHERE key IN ({marks})", batch).fetchall())
+                now = time.time()
+                conn.executemany("UPDATE entries SET last_access = ? WHERE key = ?", [(now, k) for k in found])
+                conn.execute("UPDATE counters SET value = value + ? WHERE name = 'hits'", (len(found),))
+                conn.execute("UPDATE counters SET value = value + ? WHERE name = 'misses'", (len(unique) - len(found),))
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Cache read error ({self.path}): {e}")
+        return found
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                             (key, value, len(value), time.time()))
+                self._evict(conn)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Cache write error ({self.path}): {e}")
+
+    def put_many(self, items):
+        now = time.time()
+        rows = [(k, v, len(v), now) for k, v in items if len(v) <= self.max_bytes]
+        if not rows:
+            return
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", rows)
+                self._evict(conn)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Cache write error ({self.path}): {e}")
+
+    def _evict(self, conn):
+        # Oldest entries first, read a page at a time from the last_access index
+        excess = conn.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0] - self.max_bytes
+        evicted = 0
+        while excess > 0:
+            victims = []
+            for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access LIMIT 256").fetchall():
+                victims.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            if not victims:
+                break
+            conn.executemany("DELETE FROM entries WHERE key = ?", victims)
+            evicted += len(victims)
+        if evicted:
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'evictions'", (evicted,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            try:
+                conn = self._connect()
+                counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+                entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            except sqlite3.Error as e:
+                print(f"Cache stats error ({self.path}): {e}")
+                return {}
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        return {
+            **counters,
+            "hit_rate": counters.get("hits", 0) / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": counters.get("bytes", 0),
+            "max_bytes": self.max_bytes,
+        }
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM entries")
+            conn.execute("UPDATE counters SET value = 0")   # after the delete, its triggers touched 'bytes'
+            conn.commit()
+
+
+_extraction_cache = None
+
+
+def get_extraction_cache() -> DiskCache:
+    global _extraction_cache
+    if _extraction_cache is None:
+        _extraction_cache = DiskCache(os.path.join(CACHE_DIR, "extraction.sqlite"),
+                                      int(EXTRACTION_CACHE_MAX_MB * 1024 * 1024))
+    return _extraction_cache
+
+
+def extraction_key(data: bytes, kind: str, **settings) -> str:
+    # Same bytes with different OCR settings can give different text, so settings are part of the key
+    setting_str = ",".join(f"{k}={settings[k]}" for k in sorted(settings))
+    return content_hash(EXTRACTOR_VERSION, kind, setting_str, data)
+
+
+_embedding_cache = None
+
+
+def get_embedding_cache() -> DiskCache:
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = DiskCache(os.path.join(CACHE_DIR, "embeddings.sqlite"),
+                                     int(EMBEDDING_CACHE_MAX_MB * 1024 * 1024))
+    return _embedding_cache
+
+
+def iter_embeddings_with_cache(embeddings, model_name: str, texts, use_gpu: bool = True):
+    # Yields (indices into texts, vectors): cache hits first in one batch, then misses as they get embedded.
+    # Vectors are only comparable within one model (and backend), so that id is part of the key
+    cache = get_embedding_cache()
+    keys = [content_hash(model_name, text) for text in texts]
+    found = cache.get_many(keys)
+
+    hit_indices = [i for i, k in enumerate(keys) if k in found]
+    if hit_indices:
+        yield hit_indices, [np.frombuffer(found[keys[i]], dtype=np.float32).tolist() for i in hit_indices]
+
+    miss_positions = {}   # key -> every index with that text
+    for i, k in enumerate(keys):
+        if k not in found:
+            miss_positions.setdefault(k, []).append(i)
+    miss_keys = list(miss_positions)
+    miss_texts = [texts[miss_positions[k][0]] for k in miss_keys]
+
+    embedded = 0
+    for batch, vectors in iter_embeddings(embeddings, miss_texts, use_gpu):
+        cache.put_many([(miss_keys[j], np.asarray(v, dtype=np.float32).tobytes()) for j, v in zip(batch, vectors)])
+        indices, out = [], []
+        for j, v in zip(batch, vectors):
+            for i in miss_positions[miss_keys[j]]:
+                indices.append(i)
+                out.append(list(v))
+        embedded += len(batch)
+        yield indices, out
+
+    print(f"Embedding cache: {len(hit_indices)}/{len(keys)} chunks reused, {embedded} embedded")
+
+
+class AnswerCache:
+    # In-memory answers for near-identical questions, scoped to (collection, document set fingerprint, settings).
+    # Lookup is a single matrix-vector product over the scope's cached query embeddings.
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # entry id -> (scope, unit query vector, result, created), oldest first
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(vector):
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for entry_id in [i for i, e in self._entries.items() if e[3] < cutoff]:
+            del self._entries[entry_id]
+
+    def lookup(self, scope, query_vector):
+        query = self._normalize(query_vector)
+        with self._lock:
+            self._expire()
+            candidates = [(i, e) for i, e in self._entries.items() if e[0] == scope]
+            if candidates:
+                sims = np.stack([e[1] for _, e in candidates]) @ query
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    entry_id = candidates[best][0]
+                    self._entries.move_to_end(entry_id)   # LRU
+                    self.hits += 1
+                    return candidates[best][1][2]
+            self.misses += 1
+            return None
+
+    def store(self, scope, query_vector, result):
+        with self._lock:
+            self._entries[self._next_id] = (scope, self._normalize(query_vector), result, time.time())
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection_name: str):
+        # Called whenever a collection's documents change, scopes start with the collection name
+        with self._lock:
+            for entry_id in [i for i, e in self._entries.items() if e[0][0] == collection_name]:
+                del self._entries[entry_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES)
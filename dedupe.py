@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import zlib
+import sqlite3
+import threading
+
+import numpy as np
+
+from cache import content_hash
+
+
+# Exact and near-duplicate chunks (OCR text on top of the PDF text layer, repeated slide headers and
+# footers, policy versions that differ by a line) are dropped before embedding. Chunks are compared by
+# MinHash signatures over word shingles, LSH buckets keep the lookup to a few candidates per chunk.
+DEDUPE_ENABLED = os.getenv("DEDUPE_ENABLED", "1") == "1"
+DEDUPE_THRESHOLD = float(os.getenv("DEDUPE_THRESHOLD", "0.85"))   # estimated jaccard similarity
+DEDUPE_DB_PATH = os.getenv("DEDUPE_DB_PATH", "./chroma_db/dedupe.sqlite")
+SHINGLE_WORDS = 3
+MINHASH_PERM = 64
+LSH_BANDS = 16   # 4 rows per band, pairs above ~0.6 similarity almost always share a bucket
+
+# Multiply-shift needs full 64-bit multipliers: with 32-bit ones (h * a + b) never wraps, is increasing
+# in h, and every "permutation" picks the same minimum shingle
+_rng = np.random.RandomState(7)   # fixed, signatures are stored and compared across runs
+_A = _rng.randint(0, 2 ** 64, size=MINHASH_PERM, dtype=np.uint64) | np.uint64(1)
+_B = _rng.randint(0, 2 ** 64, size=MINHASH_PERM, dtype=np.uint64)
+
+_local = threading.local()
+
+
+def _connect():
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        os.makedirs(os.path.dirname(DEDUPE_DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(DEDUPE_DB_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS signatures (
+                            collection TEXT, chunk_id TEXT, file_hash TEXT, signature BLOB,
+                            PRIMARY KEY (collection, chunk_id))""")
+        conn.execute("CREATE TABLE IF NOT EXISTS bands (collection TEXT, bucket TEXT, chunk_id TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS bands_collection ON bands (collection, chunk_id)")
+        # Dropped chunks are kept so they can come back when the file they duplicated is removed
+        conn.execute("""CREATE TABLE IF NOT EXISTS dropped (
+                            collection TEXT, chunk_id TEXT, file_hash TEXT, duplicate_of_file TEXT,
+                            content TEXT, metadata TEXT, PRIMARY KEY (collection, chunk_id))""")
+        conn.commit()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def _normalize(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def minhash_signature(normalized: str):
+    words = normalized.split()
+    if len(words) <= SHINGLE_WORDS:
+        shingles = {normalized}
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # multiply-shift hashing, one column per permutation; uint64 wraps around on purpose
+    permuted = (hashes[:, None] * _A + _B) >> np.uint64(32)
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def _buckets(signature, exact: str):
+    rows = MINHASH_PERM // LSH_BANDS
+    return [f"x:{exact}"] + [f"{b}:{signature[b * rows:(b + 1) * rows].tobytes().hex()}" for b in range(LSH_BANDS)]
+
+
+class Deduplicator:
+    # One per ingestion run. admit() decides per chunk, commit() persists what was decided once the
+    # kept chunks are in the index. collection_name=None dedupes within the run only
+
+    def __init__(self, collection_name=None, threshold: float = DEDUPE_THRESHOLD):
+        self.collection_name = collection_name
+        self.threshold = threshold
+        self.removed = 0
+        self._signatures = {}   # chunk id -> (signature, file_hash) of kept chunks
+        self._buckets = {}   # bucket -> kept chunk ids
+        self._admitted = set()   # chunk ids admitted by this run
+        self._pending_kept = []
+        self._pending_dropped = []   # (kept chunk id it duplicates, row)
+        if collection_name and DEDUPE_ENABLED:
+            self._load()
+
+    def _load(self):
+        conn = _connect()
+        for chunk_id, file_hash, blob in conn.execute(
+                "SELECT chunk_id, file_hash, signature FROM signatures WHERE collection = ?", (self.collection_name,)):
+            self._signatures[chunk_id] = (np.frombuffer(blob, dtype=np.uint32), file_hash)
+        for bucket, chunk_id in conn.execute(
+                "SELECT bucket, chunk_id FROM bands WHERE collection = ?", (self.collection_name,)):
+            self._buckets.setdefault(bucket, []).append(chunk_id)
+
+    def _find_duplicate(self, signature, buckets):
+        if buckets[0] in self._buckets:
+            return self._buckets[buckets[0]][0]
+        seen = set()
+        for bucket in buckets[1:]:
+            for candidate in self._buckets.get(bucket, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if np.mean(self._signatures[candidate][0] == signature) >= self.threshold:
+                    return candidate
+        return None
+
+    def admit(self, record) -> bool:
+        # record: (chunk id, text, metadata) as built by ingest.iter_chunk_records
+        if not DEDUPE_ENABLED:
+            return True
+        chunk_id, text, metadata = record
+        normalized = _normalize(text)
+        signature = minhash_signature(normalized)
+        buckets = _buckets(signature, content_hash(normalized)[:32])
+
+        duplicate_of = self._find_duplicate(signature, buckets)
+        if duplicate_of == chunk_id:
+            # Twice in this run: same chunk twice on one page, add_chunks keeps one copy anyway. Otherwise
+            # its signature is from an earlier run and it is being indexed again, the upsert makes that safe
+            if chunk_id in self._admitted:
+                return False
+            self._admitted.add(chunk_id)
+            return True
+        if duplicate_of is not None:
+            self.removed += 1
+            self._pending_dropped.append((duplicate_of, (chunk_id, metadata.get("file_hash", ""),
+                                                         self._signatures[duplicate_of][1], text, json.dumps(metadata))))
+            return False
+
+        self._admitted.add(chunk_id)
+
+        self._signatures[chunk_id] = (signature, metadata.get("file_hash", ""))
+        for bucket in buckets:
+            self._buckets.setdefault(bucket, []).append(chunk_id)
+        self._pending_kept.append((chunk_id, metadata.get("file_hash", ""), signature.tobytes(), buckets))
+        return True
+
+    def commit(self, chunk_ids=None):
+        # chunk_ids: admitted chunks that are in the index now, None = all of them. Signatures of chunks
+        # still waiting to be indexed stay pending, an interrupted run must not leave them behind or the
+        # retried file would be rejected as a duplicate of itself
+        if chunk_ids is None:
+            kept, self._pending_kept = self._pending_kept, []
+        else:
+            chunk_ids = set(chunk_ids)
+            kept = [entry for entry in self._pending_kept if entry[0] in chunk_ids]
+            self._pending_kept = [entry for entry in self._pending_kept if entry[0] not in chunk_ids]
+        # A dropped chunk is only recorded once the chunk it duplicates is
+        waiting = {entry[0] for entry in self._pending_kept}
+        dropped = [row for target, row in self._pending_dropped if target not in waiting]
+        self._pending_dropped = [(target, row) for target, row in self._pending_dropped if target in waiting]
+        if not self.collection_name or not (kept or dropped):
+            return
+        conn = _connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?)",
+                             [(self.collection_name, cid, fh, sig) for cid, fh, sig, _ in kept])
+            conn.executemany("INSERT INTO bands VALUES (?, ?, ?)",
+                             [(self.collection_name, bucket, cid) for cid, _, _, buckets in kept for bucket in buckets])
+            conn.executemany("INSERT OR REPLACE INTO dropped VALUES (?, ?, ?, ?, ?, ?)",
+                             [(self.collection_name, *row) for row in dropped])
+
+
+def release_file(collection_name: str, file_hash: str):
+    # Forget a removed file. Returns the (chunk id, text, metadata) records other files lost as
+    # duplicates of it, so the caller can index them again
+    conn = _connect()
+    restored = [(cid, content, json.loads(metadata)) for cid, content, metadata in conn.execute(
+        "SELECT chunk_id, content, metadata FROM dropped WHERE collection = ? AND duplicate_of_file = ? AND file_hash != ?",
+        (collection_name, file_hash, file_hash))]
+    with conn:
+        conn.execute("""DELETE FROM bands WHERE collection = ? AND chunk_id IN
+                        (SELECT chunk_id FROM signatures WHERE collection = ? AND file_hash = ?)""",
+                     (collection_name, collection_name, file_hash))
+        conn.execute("DELETE FROM signatures WHERE collection = ? AND file_hash = ?", (collection_name, file_hash))
+        conn.execute("DELETE FROM dropped WHERE collection = ? AND (file_hash = ? OR duplicate_of_file = ?)",
+                     (collection_name, file_hash, file_hash))
+    return restored
+
+
+def readmit_released(collection_name: str, file_hash: str):
+    # release_file() + admit the returned records again. The release has to come first, a Deduplicator
+    # loaded before it still holds the removed file's signatures and drops every record as their duplicate.
+    # Returns the deduplicator, commit() it once the records are indexed, and the records to index
+    released = release_file(collection_name, file_hash)
+    dedup = Deduplicator(collection_name)
+    return dedup, [record for record in released if dedup.admit(record)]
+
+
+def drop_collection(collection_name: str):
+    conn = _connect()
+    with conn:
+        for table in ("signatures", "bands", "dropped"):
+            conn.execute(f"DELETE FROM {table} WHERE collection = ?", (collection_name,))
@@ -0,0 +1,100 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import models
+
+
+# Bulk embedding for big uploads: chunks are sorted by length, cut into batches with a bounded
+# padded size, and spread over worker processes that each keep their own copy of the model.
+EMBED_POOL_WORKERS = int(os.getenv("EMBED_POOL_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // 4)
+EMBED_POOL_MIN_CHUNKS = int(os.getenv("EMBED_POOL_MIN_CHUNKS", "1024"))   # below this the in-process model wins
+EMBED_BATCH_CHARS = int(os.getenv("EMBED_BATCH_CHARS", "32000"))   # padded characters per batch
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "128"))
+
+_pool = None
+_pool_lock = threading.Lock()
+_worker_embeddings = None
+
+
+def _init_worker(threads):
+    # Split the cores between workers instead of every worker grabbing all of them
+    global _worker_embeddings
+    if models.EMBEDDING_BACKEND == "fastembed":
+        models.FASTEMBED_THREADS = threads
+    else:
+        import torch
+        torch.set_num_threads(threads)
+    _worker_embeddings = models.get_embeddings(use_gpu=False)
+
+
+def _embed_batch(indices, texts):
+    return indices, _worker_embeddings.embed_documents(texts)
+
+
+def pool_enabled(use_gpu: bool = True) -> bool:
+    if EMBED_POOL_WORKERS <= 1:
+        return False
+    # One GPU process beats several CPU workers
+    return models.EMBEDDING_BACKEND == "fastembed" or models.get_device(use_gpu) == "cpu"
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            threads = max(1, (os.cpu_count() or 1) // EMBED_POOL_WORKERS)
+            # spawn, not fork: a forked worker would inherit the parent's already loaded model (and its
+            # thread settings) instead of loading one with its share of the cores
+            _pool = ProcessPoolExecutor(max_workers=EMBED_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker, initargs=(threads,))
+            print(f"Embedding pool: {EMBED_POOL_WORKERS} workers x {threads} threads")
+        return _pool
+
+
+def _discard_pool(pool):
+    # A worker died (OOM, segfault) and took the pool with it, the next large upload starts a fresh one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def length_sorted_batches(texts, max_chars: int = EMBED_BATCH_CHARS, max_batch: int = EMBED_MAX_BATCH):
+    # Similar lengths end up together, so little of each batch is padding
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    batch = []
+    for i in order:
+        longest = len(texts[i])   # sorted ascending, the newest item is the longest
+        if batch and ((len(batch) + 1) * longest > max_chars or len(batch) >= max_batch):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def iter_embeddings(embeddings, texts, use_gpu: bool = True):
+    # Yields (indices into texts, vectors) as batches finish, in no particular order
+    batches = list(length_sorted_batches(texts))
+    if len(texts) < EMBED_POOL_MIN_CHUNKS or not pool_enabled(use_gpu):
+        for batch in batches:
+            yield batch, embeddings.embed_documents([texts[i] for i in batch])
+        return
+
+    pool = _get_pool()
+    remaining = {tuple(batch): batch for batch in batches}
+    try:
+        futures = [pool.submit(_embed_batch, batch, [texts[i] for i in batch]) for batch in batches]
+        for future in as_completed(futures):
+            indices, vectors = future.result()
+            remaining.pop(tuple(indices), None)
+            yield indices, vectors
+    except BrokenProcessPool:
+        print(f"Embedding pool broke, embedding the last {len(remaining)} batches in-process")
+        _discard_pool(pool)
+        for batch in remaining.values():
+            yield batch, embeddings.embed_documents([texts[i] for i in batch])
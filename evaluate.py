@@ -0,0 +1,219 @@
+# Offline retrieval evaluation: sweeps chunk size, overlap, k, fusion weights and reranking over a labeled
+# question -> passage set and reports recall / MRR next to per-query latency and index size, so the
+# defaults in rag.py (CHUNK_SIZE, CHUNK_OVERLAP, RETRIEVAL_K, RERANK_TOP_K) and hybrid.py (HYBRID_WEIGHTS)
+# can be picked from data.
+#
+#     python evaluate.py --corpus ./docs --labels labels.jsonl --min-recall 0.8 --output sweep.json
+#     python evaluate.py --synthetic 40   # no data needed, questions drawn from benchmark.py's corpus
+#
+# labels.jsonl: one {"question": "...", "passages": ["text that answers it", ...]} per line. A retrieved chunk
+# counts as a hit for a passage when it contains at least --match of the passage's word bigrams, so labels
+# stay valid whatever the chunk size. No LLM calls, stores live in a temporary work dir like benchmark.py.
+
+import os
+import re
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+
+import numpy as np
+
+from benchmark import Upload, build_corpus, isolate_stores
+
+
+KIND_BY_EXTENSION = {".pdf": "pdf", ".docx": "docx", ".pptx": "pptx", ".html": "html", ".htm": "html",
+                     ".txt": "txt", ".md": "txt", ".png": "image", ".jpg": "image", ".jpeg": "image"}
+KINDS = ("pdf", "docx", "pptx", "html", "txt", "image")
+
+
+def load_corpus(directory):
+    corpus = {kind: [] for kind in KINDS}
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            kind = KIND_BY_EXTENSION.get(os.path.splitext(name)[1].lower())
+            if kind:
+                with open(os.path.join(root, name), "rb") as f:
+                    corpus[kind].append(Upload(name, f.read()))
+    return corpus
+
+
+def load_labels(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_labels(texts, count: int, seed: int):
+    # Question = a corpus sentence with a third of its words dropped and the rest shuffled, passage = the sentence
+    rng = random.Random(seed + 2)
+    sentences = [s.strip() for text in texts for s in re.split(r"(?<=\.)\s+", text) if len(s.split()) >= 8]
+    labels = []
+    for sentence in rng.sample(sentences, min(count, len(sentences))):
+        words = re.findall(r"\w+", sentence)
+        kept = rng.sample(words, max(4, len(words) * 2 // 3))
+        labels.append({"question": " ".join(kept) + "?", "passages": [sentence]})
+    return labels
+
+
+def _bigrams(text):
+    words = re.findall(r"\w+", text.lower())
+    return set(zip(words, words[1:])) or {(w,) for w in words}
+
+
+def _matches(chunk_bigrams, passage_bigrams, threshold):
+    return len(chunk_bigrams & passage_bigrams) >= threshold * len(passage_bigrams)
+
+
+def score_ranking(docs, passages, threshold):
+    # (recall, reciprocal rank of the first relevant chunk)
+    passage_bigrams = [_bigrams(p) for p in passages]
+    found, first = set(), None
+    for rank, doc in enumerate(docs, 1):
+        chunk_bigrams = _bigrams(doc.page_content)
+        hits = {i for i, pb in enumerate(passage_bigrams) if _matches(chunk_bigrams, pb, threshold)}
+        if hits and first is None:
+            first = rank
+        found |= hits
+    return len(found) / len(passages), (1 / first if first else 0.0)
+
+
+def _index_size(vectorstore, session_id):
+    from vector_index import NumpyVectorStore
+    from sessions import disk_usage
+    if isinstance(vectorstore, NumpyVectorStore):
+        return vectorstore.stats()["bytes"]
+    return disk_usage()["sessions"].get(f"session_{session_id}", {}).get("vector_bytes")
+
+
+def sweep(args, texts, labels):
+    from rag import get_text_chunks, get_vectorstore
+    from hybrid import hybrid_search
+    from reranker import rerank_documents, score_cache
+    from sessions import delete_session
+
+    results = []
+    for chunk_size, overlap in itertools.product(args.chunk_sizes, args.overlaps):
+        if overlap >= chunk_size:
+            continue
+        session_id = f"eval-{chunk_size}-{overlap}"
+        chunks = [c for text in texts for c in get_text_chunks(text, chunk_size, overlap)]
+        start = time.perf_counter()
+        vectorstore = get_vectorstore(chunks, session_id, use_gpu=not args.cpu)
+        ingest_seconds = time.perf_counter() - start
+        index = {"chunks": len(chunks), "index_bytes": _index_size(vectorstore, session_id),
+                 "ingest_s": round(ingest_seconds, 2)}
+
+        for k, weights, rerank in itertools.product(args.ks, args.weights, args.rerank):
+            score_cache.clear()   # every configuration pays for its own reranking
+            latencies, recalls, candidate_recalls, reciprocal_ranks = [], [], [], []
+            for label in labels:
+                start = time.perf_counter()
+                docs = hybrid_search(vectorstore, f"session_{session_id}", [label["question"]], k=k, weights=weights)
+                if rerank and len(docs) > args.top_k:
+                    final = rerank_documents(docs, label["question"], top_k=args.top_k)
+                else:
+                    final = docs[:args.top_k]
+                latencies.append(time.perf_counter() - start)
+
+                recall, rr = score_ranking(final, label["passages"], args.match)
+                recalls.append(recall)
+                reciprocal_ranks.append(rr)
+                candidate_recalls.append(score_ranking(docs, label["passages"], args.match)[0])
+
+            latency_ms = np.array(latencies) * 1000
+            results.append({
+                "chunk_size": chunk_size,
+                "overlap": overlap,
+                "k": k,
+                "weights": list(weights),
+                "rerank": rerank,
+                "top_k": args.top_k,
+                f"recall@{args.top_k}": round(float(np.mean(recalls)), 4),
+                "mrr": round(float(np.mean(reciprocal_ranks)), 4),
+                "candidate_recall": round(float(np.mean(candidate_recalls)), 4),
+                "p50_ms": round(float(np.percentile(latency_ms, 50)), 2),
+                "p95_ms": round(float(np.percentile(latency_ms, 95)), 2),
+                **index,
+            })
+            print(json.dumps(results[-1]))
+
+        delete_session(session_id)
+    return results
+
+
+def cheapest(results, recall_key, min_recall):
+    # Lowest p50 latency that meets the bar, smaller index breaks ties
+    passing = [r for r in results if r[recall_key] >= min_recall]
+    if not passing:
+        return None
+    return min(passing, key=lambda r: (r["p50_ms"], r["index_bytes"] or 0))
+
+
+def _ints(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep retrieval settings against a labeled question set")
+    parser.add_argument("--corpus", help="directory with the documents the labels refer to")
+    parser.add_argument("--labels", help="JSONL file of {question, passages}")
+    parser.add_argument("--synthetic", type=int, default=0, help="generate this many labeled questions instead")
+    parser.add_argument("--chunk-sizes", type=_ints, default=[200, 400, 600])
+    parser.add_argument("--overlaps", type=_ints, default=[0, 80])
+    parser.add_argument("--ks", type=_ints, default=[5, 8, 12], help="hybrid candidates per query")
+    parser.add_argument("--weights", default="0.6:0.4,0.5:0.5,1:0",
+                        type=lambda v: [tuple(float(x) for x in w.split(":")) for w in v.split(",")],
+                        help="semantic:lexical pairs")
+    parser.add_argument("--rerank", default="on,off", type=lambda v: [x.strip() == "on" for x in v.split(",")])
+    parser.add_argument("--top-k", type=int, default=5, help="chunks that would go into the prompt")
+    parser.add_argument("--match", type=float, default=0.5, help="share of a passage's bigrams a chunk must contain")
+    parser.add_argument("--min-recall", type=float, default=0.8, help="quality bar for the recommendation")
+    parser.add_argument("--seed", type=int, default=13)
+    parser.add_argument("--cpu", action="store_true", help="don't use the GPU")
+    parser.add_argument("--output", help="write all results as JSON here")
+    parser.add_argument("--workdir", help="where the evaluation's stores go (default: a temp dir, removed after)")
+    args = parser.parse_args()
+    if not args.synthetic and not (args.corpus and args.labels):
+        parser.error("pass --corpus and --labels, or --synthetic N")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="smartbot-eval-")
+    isolate_stores(workdir)
+    try:
+        from processor import _collect_jobs, extract_documents
+        corpus = build_corpus(3, 5, args.seed) if args.synthetic else load_corpus(args.corpus)
+        texts = [t for t in extract_documents(_collect_jobs(*(corpus[kind] for kind in KINDS)), False, "") if t.strip()]
+        labels = synthetic_labels(texts, args.synthetic, args.seed) if args.synthetic else load_labels(args.labels)
+        print(f"{len(texts)} documents, {len(labels)} labeled questions")
+        results = sweep(args, texts, labels)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    recall_key = f"recall@{args.top_k}"
+    print(f"\n{'size':>5} {'ovl':>4} {'k':>3} {'weights':>9} {'rerank':>6} {recall_key:>9} {'mrr':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'chunks':>7} {'index MB':>9}")
+    for r in sorted(results, key=lambda r: (-r[recall_key], r["p50_ms"])):
+        index_mb = f"{r['index_bytes'] / 1e6:.2f}" if r["index_bytes"] is not None else "-"
+        print(f"{r['chunk_size']:>5} {r['overlap']:>4} {r['k']:>3} {':'.join(f'{w:g}' for w in r['weights']):>9} "
+              f"{'on' if r['rerank'] else 'off':>6} {r[recall_key]:>9.3f} {r['mrr']:>6.3f} {r['p50_ms']:>8.1f} "
+              f"{r['p95_ms']:>8.1f} {r['chunks']:>7} {index_mb:>9}")
+
+    best = cheapest(results, recall_key, args.min_recall)
+    if best:
+        print(f"\nCheapest configuration with {recall_key} >= {args.min_recall}: chunk size {best['chunk_size']}, "
+              f"overlap {best['overlap']}, k {best['k']}, weights {best['weights']}, "
+              f"reranking {'on' if best['rerank'] else 'off'} ({best['p50_ms']} ms p50)")
+    else:
+        print(f"\nNo configuration reached {recall_key} >= {args.min_recall}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"labels": len(labels), "min_recall": args.min_recall, "recommended": best, "results": results},
+                      f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
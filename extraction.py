@@ -1,5 +1,6 @@
 import os
 import io
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 
@@ -14,37 +15,71 @@ from pptx import Presentation
 
 from bs4 import BeautifulSoup
 
-def extract_pdf_text(pdf_file, enable_ocr=False, poppler_path=None):
-    text = ""
-    pdf_bytes = pdf_file.read()
+MIN_PAGE_TEXT_CHARS = int(os.getenv("MIN_PAGE_TEXT_CHARS", "40"))   # below this a page is treated as scanned
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "4"))   # pages OCRed at once, processor.py lowers it inside ingestion workers
+
+
+def _page_needs_ocr(page_text):
+    stripped = page_text.strip()
+    if len(stripped) < MIN_PAGE_TEXT_CHARS:
+        return True
+    # Broken text layers come out as mostly symbols / (cid:xx) garbage
+    readable = sum(ch.isalnum() or ch.isspace() for ch in stripped)
+    return readable / len(stripped) < 0.6
+
+
+def _ocr_pdf_page(pdf_bytes, page_num, poppler_path):
+    try:
+        # Rasterize only this page, rendering the whole document at once blows up memory
+        images = convert_from_bytes(pdf_bytes, first_page=page_num, last_page=page_num, poppler_path=poppler_path)
+        return "\n".join(ocr_image(img) or "" for img in images)
+    except:
+        return ""
+
+
+def extract_pdf_pages(pdf_bytes, enable_ocr=False, poppler_path=None):
+    pages = []
     try:
         with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:   # High level Structured img, tables and text Extractor, But easily fails in non structured cases so i ave a fallback
             for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
+                pages.append(page.extract_text() or "")
     except:
-        pass
-    if not text.strip():
+        pages = []
+    if not any(p.strip() for p in pages):
         try:
             pdf_reader = PdfReader(io.BytesIO(pdf_bytes))  #plain text extraction ,Basic low level reader used in unstructered pdfs as fallback
-            for page in pdf_reader.pages:
-                t = page.extract_text()
-                if t:
-                    text += t + "\n"
-        except:
-            pass
-    if enable_ocr or not text.strip():
-        try:
-            poppler_path = os.getenv("POPPLER_PATH")
-            images = convert_from_bytes(pdf_bytes, poppler_path=poppler_path)   # From Scanned Images gives text 
-            for img in images:
-                ocr_text = ocr_image(img)
-                if ocr_text:
-                    text += ocr_text + "\n"
+            fallback = [page.extract_text() or "" for page in pdf_reader.pages]
+            if any(p.strip() for p in fallback) or not pages:
+                pages = fallback
         except:
             pass
-    return text
+
+    has_text = any(p.strip() for p in pages)
+    if enable_ocr or not has_text:
+        poppler_path = poppler_path or os.getenv("POPPLER_PATH")
+        if not pages:
+            # Neither reader could even count the pages, let poppler render everything
+            try:
+                images = convert_from_bytes(pdf_bytes, poppler_path=poppler_path)
+                return [ocr_image(img) or "" for img in images]
+            except:
+                return []
+
+        # OCR only the pages without a usable text layer, and replace their text instead of appending
+        ocr_pages = [i for i, p in enumerate(pages) if _page_needs_ocr(p)]
+        if ocr_pages:
+            with ThreadPoolExecutor(max_workers=max(1, min(OCR_WORKERS, len(ocr_pages)))) as pool:   # tesseract runs out of process, threads are enough
+                results = pool.map(lambda i: _ocr_pdf_page(pdf_bytes, i + 1, poppler_path), ocr_pages)
+                for i, ocr_text in zip(ocr_pages, results):
+                    if len(ocr_text.strip()) > len(pages[i].strip()):
+                        pages[i] = ocr_text
+    return pages
+
+
+def extract_pdf_text(pdf_file, enable_ocr=False, poppler_path=None):
+    pdf_bytes = pdf_file.read()
+    pages = extract_pdf_pages(pdf_bytes, enable_ocr, poppler_path)
+    return "".join(p + "\n" for p in pages if p.strip())
 
 def extract_docx_text(docx_file):
     text = ""
@@ -61,12 +96,12 @@ def extract_docx_text(docx_file):
         pass
     return text
 
-def extract_pptx_text(pptx_file):
-    text = ""
+def extract_pptx_slides(pptx_file):
+    slides = []
     try:
         prs = Presentation(io.BytesIO(pptx_file.read()))
         for slide_num, slide in enumerate(prs.slides, 1):
-            text += f"\n### Slide {slide_num}\n"
+            text = f"\n### Slide {slide_num}\n"
             for shape in slide.shapes:
                 if hasattr(shape, "text") and shape.text.strip():
                     text += shape.text + "\n"
@@ -77,9 +112,13 @@ def extract_pptx_text(pptx_file):
                         text += f"[Notes]: {notes}\n"
             except:
                 pass
+            slides.append(text)
     except:
         pass
-    return text
+    return slides
+
+def extract_pptx_text(pptx_file):
+    return "".join(extract_pptx_slides(pptx_file))
 
 def extract_html_text(html_file):
     text = ""
@@ -0,0 +1,127 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+
+from lexical import search as lexical_search
+from vector_index import NumpyVectorStore
+from tracing import span
+
+
+# Semantic + keyword retrieval fused by chunk id. Each side returns HYBRID_CANDIDATES candidates,
+# the fused list is cut to k and every document carries its fusion score in metadata["fusion_score"].
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "rrf")   # rrf (reciprocal rank) or score (min-max normalized scores)
+HYBRID_WEIGHTS = tuple(float(w) for w in os.getenv("HYBRID_WEIGHTS", "0.6,0.4").split(","))   # semantic, lexical
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))   # per retriever and query, never less than k
+RRF_K = int(os.getenv("RRF_K", "60"))
+HYBRID_SEARCH_THREADS = int(os.getenv("HYBRID_SEARCH_THREADS", "8"))
+
+# One pool for the whole process, so lexical.py's per-thread sqlite connections are reused across queries
+_search_pool = ThreadPoolExecutor(max_workers=HYBRID_SEARCH_THREADS, thread_name_prefix="hybrid")
+
+
+# filters: {"file_hashes": [...], "file_types": ["PDF", ...], "page_range": (first, last)}, any key optional.
+# Turned into a chroma `where` here and into SQL in lexical.py, so both sides search the same subset
+
+def build_chroma_filter(filters):
+    if not filters:
+        return None
+    clauses = []
+    if filters.get("file_hashes"):
+        clauses.append({"file_hash": {"$in": list(filters["file_hashes"])}})
+    if filters.get("file_types"):
+        clauses.append({"file_type": {"$in": list(filters["file_types"])}})
+    if filters.get("page_range"):
+        first, last = filters["page_range"]
+        clauses += [{"page": {"$gte": first}}, {"page": {"$lte": last}}]
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def semantic_search(vectorstore, query_vector, k: int, where=None):
+    # (doc, score) with higher = closer for both stores
+    if isinstance(vectorstore, NumpyVectorStore):
+        return vectorstore.similarity_search_with_score_by_vector(query_vector, k, filter=where)
+    results = vectorstore.similarity_search_by_vector_with_relevance_scores(query_vector, k, filter=where)
+    return [(doc, -distance) for doc, distance in results]   # chroma returns distances
+
+
+def keyword_search(collection_name: str, query: str, k: int, filters=None):
+    return [(Document(page_content=content, metadata=metadata), score)
+            for _, content, score, metadata in lexical_search(collection_name, query, k, filters)]
+
+
+def _chunk_key(doc):
+    return doc.metadata.get("chunk_id") or doc.page_content
+
+
+def fuse(result_lists, weights, method: str = HYBRID_FUSION, c: int = RRF_K):
+    # result_lists: [(doc, score), ...] per retriever run, best first. Contributions of every list are
+    # summed per chunk id with one bincount, so cost grows with the candidate count only
+    keys, contributions, docs = [], [], {}
+    for results, weight in zip(result_lists, weights):
+        if not results:
+            continue
+        if method == "score":
+            scores = np.array([score for _, score in results], dtype=np.float64)
+            spread = scores.max() - scores.min()
+            normalized = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+            contributions.append(weight * normalized)
+        else:
+            contributions.append(weight / (c + np.arange(1, len(results) + 1)))
+        for doc, _ in results:
+            key = _chunk_key(doc)
+            keys.append(key)
+            docs.setdefault(key, doc)
+    if not keys:
+        return []
+
+    unique, inverse = np.unique(np.array(keys), return_inverse=True)
+    totals = np.bincount(inverse, weights=np.concatenate(contributions))
+    order = np.argsort(-totals, kind="stable")
+    return [(docs[unique[i]], float(totals[i])) for i in order]
+
+
+def hybrid_search(vectorstore, collection_name: str, queries, k: int = 8, filters=None, query_vectors=None,
+                  weights=None, candidates: Optional[int] = None, method: str = HYBRID_FUSION):
+    # All queries are embedded in one batch and every vector / keyword lookup runs concurrently,
+    # then all lists go through a single fusion pass. Returns the top k documents.
+    weights = weights or HYBRID_WEIGHTS
+    depth = max(k, candidates or HYBRID_CANDIDATES)
+    where = build_chroma_filter(filters)
+    with span("retrieve", queries=len(queries), k=k, candidates=depth, fusion=method) as s:
+        if query_vectors is None:
+            query_vectors = vectorstore.embeddings.embed_documents(list(queries))
+
+        semantic_futures = [_search_pool.submit(semantic_search, vectorstore, vec, depth, where) for vec in query_vectors]
+        lexical_futures = [_search_pool.submit(keyword_search, collection_name, q, depth, filters) for q in queries]
+        result_lists, list_weights = [], []
+        for semantic, lexical in zip(semantic_futures, lexical_futures):
+            result_lists += [semantic.result(), lexical.result()]
+            list_weights += list(weights)
+
+        fused = fuse(result_lists, list_weights, method)
+        s.set(semantic_hits=sum(len(r) for r in result_lists[::2]), lexical_hits=sum(len(r) for r in result_lists[1::2]),
+              fused=len(fused), returned=min(k, len(fused)))
+    return [Document(page_content=doc.page_content, metadata={**doc.metadata, "fusion_score": score})
+            for doc, score in fused[:k]]
+
+
+class HybridRetriever(BaseRetriever):
+    vectorstore: Any
+    collection_name: str
+    k: int = 8
+    filters: Optional[dict] = None
+    weights: Optional[tuple] = None
+    candidates: Optional[int] = None
+    fusion: str = HYBRID_FUSION
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return hybrid_search(self.vectorstore, self.collection_name, [query], self.k, self.filters,
+                             query_vectors=[self.vectorstore.embeddings.embed_query(query)],
+                             weights=self.weights, candidates=self.candidates, method=self.fusion)
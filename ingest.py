@@ -0,0 +1,176 @@
+import os
+import time
+import sqlite3
+import threading
+
+from cache import content_hash
+from dedupe import Deduplicator, readmit_released, drop_collection
+from tracing import span
+from processor import _collect_jobs, iter_extracted, read_upload
+from rag import get_text_chunks, open_vectorstore, add_chunks, remove_chunks, maybe_promote
+
+
+# Which files (by content hash) are already in each session's collection, so re-processing
+# only touches what changed
+MANIFEST_DB_PATH = os.getenv("MANIFEST_DB_PATH", "./chroma_db/manifest.sqlite")
+
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "2048"))   # chunks handed to embedding at once, big enough for the pool
+
+FILE_TYPE_LABELS = {"pdf": "PDF", "docx": "DOCX", "pptx": "PPTX", "html": "HTML", "txt": "TXT/MD", "image": "Images"}
+
+_local = threading.local()
+
+
+def _connect():
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        os.makedirs(os.path.dirname(MANIFEST_DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(MANIFEST_DB_PATH, timeout=30)
+        conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+                            collection TEXT, file_hash TEXT, name TEXT, file_type TEXT,
+                            chunk_count INTEGER, added_at REAL, PRIMARY KEY (collection, file_hash))""")
+        conn.commit()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def list_documents(session_id) -> list:
+    rows = _connect().execute(
+        "SELECT file_hash, name, file_type, chunk_count FROM documents WHERE collection = ? ORDER BY added_at",
+        (f"session_{session_id}",)
+    ).fetchall()
+    return [{"file_hash": h, "name": n, "file_type": t, "chunks": c} for h, n, t, c in rows]
+
+
+def indexed_collections() -> dict:
+    # collection -> chunk count, for every collection with at least one file
+    rows = _connect().execute("SELECT collection, SUM(chunk_count) FROM documents GROUP BY collection").fetchall()
+    return dict(rows)
+
+
+def document_stats(session_id) -> dict:
+    docs = list_documents(session_id)
+    docs_by_type = {}
+    for doc in docs:
+        docs_by_type[doc["file_type"]] = docs_by_type.get(doc["file_type"], 0) + 1
+    return {
+        "total_chunks": sum(doc["chunks"] for doc in docs),
+        "doc_count": len(docs),
+        "docs_by_type": docs_by_type,
+    }
+
+
+def iter_chunk_records(name, kind, file_hash, pages):
+    # (chunk id, text, metadata) per chunk; ids include the file so one file can be removed alone
+    for page, text in pages:
+        metadata = {"source": name, "file_type": FILE_TYPE_LABELS[kind], "file_hash": file_hash}
+        if page is not None:
+            metadata["page"] = page
+        for chunk in get_text_chunks(text):
+            yield content_hash(file_hash, str(page), chunk)[:32], chunk, dict(metadata)
+
+
+def add_documents(vectorstore, session_id, pdf_docs, docx_docs, pptx_docs, html_docs, txt_docs, image_docs,
+                  enable_ocr, poppler_path, use_gpu: bool = True):
+    with span("ingest", ocr=enable_ocr) as s:
+        vectorstore, result = _add_documents(vectorstore, session_id, pdf_docs, docx_docs, pptx_docs, html_docs,
+                                             txt_docs, image_docs, enable_ocr, poppler_path, use_gpu)
+        s.set(added=len(result["added"]), already_indexed=result["already_indexed"], empty=len(result["empty"]),
+              duplicates=result["duplicates"])
+    return vectorstore, result
+
+
+def _add_documents(vectorstore, session_id, pdf_docs, docx_docs, pptx_docs, html_docs, txt_docs, image_docs,
+                   enable_ocr, poppler_path, use_gpu):
+    # Extract, chunk and embed only files that aren't in the session's collection yet.
+    # Pages stream through chunking into embedding batches, nothing holds the whole corpus
+    if vectorstore is None:
+        vectorstore = open_vectorstore(session_id, use_gpu)
+
+    indexed = {doc["file_hash"] for doc in list_documents(session_id)}
+    jobs = _collect_jobs(pdf_docs, docx_docs, pptx_docs, html_docs, txt_docs, image_docs)
+    new_jobs, new_hashes = [], []
+    for job in jobs:
+        file_hash = content_hash(read_upload(job[2]))
+        if file_hash in indexed:
+            continue
+        indexed.add(file_hash)   # same file uploaded twice in one batch
+        new_jobs.append(job)
+        new_hashes.append(file_hash)
+
+    batch = []   # (chunk id, text, metadata) waiting to be embedded
+    dedup = Deduplicator(f"session_{session_id}")   # also sees chunks of files indexed earlier
+
+    def flush():
+        nonlocal vectorstore
+        if batch:
+            ids, texts, metadatas = zip(*batch)
+            add_chunks(vectorstore, session_id, list(texts), list(metadatas), list(ids), use_gpu)
+            batch.clear()
+            dedup.commit(ids)
+            vectorstore = maybe_promote(vectorstore, session_id, use_gpu)   # in-memory index -> chroma when it gets big
+
+    done, empty = [], []
+    for ((kind, name, _), pages), file_hash in zip(iter_extracted(new_jobs, enable_ocr, poppler_path), new_hashes):
+        with span("chunk", source=name, pages=len(pages)) as s:
+            records = list(iter_chunk_records(name, kind, file_hash, pages))
+            s.set(chunks=len(records))
+        with span("dedupe", source=name, chunks=len(records)) as s:
+            removed_before = dedup.removed
+            admitted = [record for record in records if dedup.admit(record)]
+            s.set(removed=dedup.removed - removed_before)
+        chunk_ids = {record[0] for record in records}
+        kept = {record[0] for record in admitted}
+        for record in admitted:
+            batch.append(record)
+            if len(batch) >= INGEST_EMBED_BATCH:
+                flush()
+        if not chunk_ids:
+            print(f"No text extracted from {name}")
+            empty.append(name)
+            continue
+        done.append((file_hash, name, FILE_TYPE_LABELS[kind], len(kept)))
+    flush()
+    dedup.commit()   # everything is indexed, this writes what the last flush couldn't (chunks dropped after it)
+
+    # Recorded only once every chunk is in the index, an interrupted run just redoes those files
+    conn = _connect()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+                         [(f"session_{session_id}", h, n, t, c, time.time()) for h, n, t, c in done])
+
+    added = [name for _, name, _, _ in done]
+    already_indexed = len(jobs) - len(new_jobs)
+    print(f"Ingestion: {len(added)} new files indexed, {already_indexed} already indexed, {len(empty)} empty, "
+          f"{dedup.removed} duplicate chunks dropped")
+    return vectorstore, {"added": added, "already_indexed": already_indexed, "empty": empty,
+                         "duplicates": dedup.removed}
+
+
+def remove_document(vectorstore, session_id, file_hash: str, use_gpu: bool = True):
+    collection_name = f"session_{session_id}"
+    remove_chunks(vectorstore, session_id, file_hash)
+
+    # Chunks other files lost as duplicates of this one go back into the index
+    dedup, restored = readmit_released(collection_name, file_hash)
+    if restored:
+        ids, texts, metadatas = zip(*restored)
+        add_chunks(vectorstore, session_id, list(texts), list(metadatas), list(ids), use_gpu)
+    dedup.commit()
+
+    restored_per_file = {}
+    for _, _, metadata in restored:
+        restored_per_file[metadata["file_hash"]] = restored_per_file.get(metadata["file_hash"], 0) + 1
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM documents WHERE collection = ? AND file_hash = ?", (collection_name, file_hash))
+        conn.executemany("UPDATE documents SET chunk_count = chunk_count + ? WHERE collection = ? AND file_hash = ?",
+                         [(count, collection_name, h) for h, count in restored_per_file.items()])
+
+
+def forget_session(session_id):
+    drop_collection(f"session_{session_id}")
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM documents WHERE collection = ?", (f"session_{session_id}",))
@@ -0,0 +1,122 @@
+import os
+import re
+import sqlite3
+import threading
+
+
+# Keyword index that lives next to the chroma collections, one FTS5 table per session collection
+# so BM25 statistics only come from that session's documents.
+LEXICAL_DB_PATH = os.getenv("LEXICAL_DB_PATH", "./chroma_db/lexical.sqlite")
+
+_local = threading.local()   # sqlite connections can't be shared between streamlit's script threads
+
+
+def _connect():
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        os.makedirs(os.path.dirname(LEXICAL_DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(LEXICAL_DB_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def _table(collection_name: str) -> str:
+    return "fts_" + re.sub(r"[^0-9A-Za-z_]", "_", collection_name)
+
+
+def _match_expression(query: str) -> str:
+    # Quote every term so user text can't be parsed as FTS5 syntax, OR them like BM25 does
+    terms = dict.fromkeys(re.findall(r"\w+", query.lower()))
+    return " OR ".join(f'"{t}"' for t in terms)
+
+
+COLUMNS = ["content", "chunk_id", "file_hash", "source", "file_type", "page"]   # only content is tokenized, the rest are UNINDEXED
+
+
+def _ensure_table(conn, table):
+    existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if existing and existing != COLUMNS:
+        # Created by an older version, the session has to re-process its files anyway
+        print(f"Lexical index {table} has an old schema, recreating it")
+        conn.execute(f"DROP TABLE {table}")
+        existing = []
+    if not existing:
+        unindexed = ", ".join(f"{c} UNINDEXED" for c in COLUMNS[1:])
+        conn.execute(f"CREATE VIRTUAL TABLE {table} USING fts5(content, {unindexed}, tokenize='porter unicode61')")
+
+
+def index_chunks(collection_name: str, ids, texts, metadatas=None):
+    metadatas = metadatas or [{} for _ in ids]
+    table = _table(collection_name)
+    conn = _connect()
+    with conn:
+        _ensure_table(conn, table)
+        for start in range(0, len(ids), 500):
+            batch = list(ids[start:start + 500])
+            marks = ",".join("?" * len(batch))
+            conn.execute(f"DELETE FROM {table} WHERE chunk_id IN ({marks})", batch)   # re-processing replaces, never duplicates
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+            [(text, cid, meta.get("file_hash", ""), meta.get("source", ""), meta.get("file_type", ""), meta.get("page"))
+             for text, cid, meta in zip(texts, ids, metadatas)]
+        )
+    print(f"Lexical index: {len(ids)} chunks in {table}")
+
+
+def delete_file_chunks(collection_name: str, file_hash: str):
+    table = _table(collection_name)
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute(f"DELETE FROM {table} WHERE file_hash = ?", (file_hash,))
+    except sqlite3.OperationalError as e:
+        print(f"Lexical delete error: {e}")
+
+
+def _filter_clause(filters):
+    # Same filter dict the vector side turns into a chroma `where`
+    clauses, params = [], []
+    if not filters:
+        return "", params
+    if filters.get("file_hashes"):
+        clauses.append(f"file_hash IN ({','.join('?' * len(filters['file_hashes']))})")
+        params += list(filters["file_hashes"])
+    if filters.get("file_types"):
+        clauses.append(f"file_type IN ({','.join('?' * len(filters['file_types']))})")
+        params += list(filters["file_types"])
+    if filters.get("page_range"):
+        clauses.append("page BETWEEN ? AND ?")
+        params += list(filters["page_range"])
+    return "".join(f" AND {c}" for c in clauses), params
+
+
+def search(collection_name: str, query: str, k: int = 4, filters=None):
+    match = _match_expression(query)
+    if not match:
+        return []
+    table = _table(collection_name)
+    where, params = _filter_clause(filters)
+    try:
+        rows = _connect().execute(
+            f"SELECT chunk_id, content, bm25({table}), source, file_type, page, file_hash FROM {table} "
+            f"WHERE {table} MATCH ?{where} ORDER BY bm25({table}) LIMIT ?",
+            (match, *params, k)
+        ).fetchall()
+    except sqlite3.OperationalError as e:   # no table yet for this session
+        print(f"Lexical search error: {e}")
+        return []
+    results = []
+    for chunk_id, content, score, source, file_type, page, file_hash in rows:
+        metadata = {"chunk_id": chunk_id, "source": source, "file_type": file_type, "file_hash": file_hash}
+        if page is not None:
+            metadata["page"] = page
+        results.append((chunk_id, content, -score, metadata))   # fts5 bm25 is lower-is-better
+    return results
+
+
+def drop_index(collection_name: str):
+    conn = _connect()
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {_table(collection_name)}")
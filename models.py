@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+
+from tracing import rss_mb, span
+
+
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+# sentence-transformers (PyTorch) or fastembed (ONNX runtime, quantized weights, no torch import)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence-transformers")
+FASTEMBED_THREADS = int(os.getenv("FASTEMBED_THREADS", "0")) or None   # None = onnxruntime default
+FASTEMBED_BATCH_SIZE = int(os.getenv("FASTEMBED_BATCH_SIZE", "256"))
+RERANKER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"   # Lightweight cross-encoder for reranking
+RERANKER_BACKEND = os.getenv("RERANKER_BACKEND", "torch")   # torch or onnx (int8 quantized, CPU)
+RERANKER_ONNX_FILE = os.getenv("RERANKER_ONNX_FILE", "onnx/model_qint8_avx512.onnx")
+RERANKER_MAX_LENGTH = int(os.getenv("RERANKER_MAX_LENGTH", "256"))   # tokens per (query, chunk) pair
+
+# One copy of every model per process, shared by all streamlit sessions
+_models = {}
+_load_stats = {}
+_registry_lock = threading.Lock()
+_key_locks = {}
+_devices = {}   # use_gpu -> resolved device, torch is only asked once
+
+
+def _get_or_load(key, loader):
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _registry_lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    with key_lock:   # other sessions asking for the same model wait here instead of loading it again
+        model = _models.get(key)
+        if model is not None:
+            return model
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        with span("model_load", model=key):
+            model = loader()
+        elapsed = time.perf_counter() - start
+        rss_after = rss_mb()
+        _load_stats[key] = {
+            "load_seconds": round(elapsed, 2),
+            "memory_mb": round(rss_after - rss_before, 1) if rss_before is not None and rss_after is not None else None,
+        }
+        print(f"Loaded {key} in {elapsed:.2f}s")
+        _models[key] = model
+        return model
+
+
+def get_device(use_gpu: bool = True) -> str:
+    device = _devices.get(use_gpu)
+    if device is not None:
+        return device
+
+    import torch
+
+    # Check if GPU is actually available
+    has_gpu = torch.cuda.is_available()
+    if use_gpu and not has_gpu:
+        print("GPU was not available. Using CPU instead.")
+    device = "cuda" if (use_gpu and has_gpu) else "cpu"
+    _devices[use_gpu] = device
+    return device
+
+
+def embedding_model_id() -> str:
+    # Backends don't produce identical vectors for the same model name, so caches and collections
+    # are keyed by backend + model
+    return f"{EMBEDDING_BACKEND}:{EMBEDDING_MODEL}"
+
+
+def get_embeddings(use_gpu: bool = True):
+    if EMBEDDING_BACKEND == "fastembed":
+        def load():
+            from langchain_community.embeddings import FastEmbedEmbeddings
+            print(f"Embeddings using: fastembed/onnx ({FASTEMBED_THREADS or 'default'} threads)")
+            return FastEmbedEmbeddings(
+                model_name=EMBEDDING_MODEL,   # fastembed ships this one as a quantized onnx model
+                threads=FASTEMBED_THREADS,
+                batch_size=FASTEMBED_BATCH_SIZE
+            )
+
+        return _get_or_load(f"embeddings:{embedding_model_id()}", load)
+
+    device = get_device(use_gpu)
+
+    def load():
+        from langchain_community.embeddings import SentenceTransformerEmbeddings
+        print(f"Embeddings using: {device.upper()}")
+        return SentenceTransformerEmbeddings(
+            model_name=EMBEDDING_MODEL,
+            model_kwargs={"device": device}
+        )
+
+    return _get_or_load(f"embeddings:{embedding_model_id()}:{device}", load)
+
+
+def reranker_model_id() -> str:
+    return f"{RERANKER_BACKEND}:{RERANKER_MODEL}:{RERANKER_MAX_LENGTH}"
+
+
+def get_cross_encoder(use_gpu: bool = True):
+    if RERANKER_BACKEND == "onnx":
+        def load():
+            from sentence_transformers import CrossEncoder
+            try:
+                return CrossEncoder(RERANKER_MODEL, max_length=RERANKER_MAX_LENGTH, backend="onnx",
+                                    model_kwargs={"file_name": RERANKER_ONNX_FILE})
+            except TypeError:   # sentence-transformers too old for cross-encoder backends
+                print("ONNX reranker needs sentence-transformers>=4.1. Using torch instead.")
+                return CrossEncoder(RERANKER_MODEL, max_length=RERANKER_MAX_LENGTH, device="cpu")
+
+        return _get_or_load(f"reranker:{reranker_model_id()}", load)
+
+    device = get_device(use_gpu)
+
+    def load():
+        from sentence_transformers import CrossEncoder
+        return CrossEncoder(RERANKER_MODEL, max_length=RERANKER_MAX_LENGTH, device=device)
+
+    return _get_or_load(f"reranker:{reranker_model_id()}:{device}", load)
+
+
+def warm_up_models(use_gpu: bool = True):
+    # Called once at app start so the first query doesn't pay for loading from disk
+    embeddings = get_embeddings(use_gpu)
+    embeddings.embed_query("warm up")
+    try:
+        get_cross_encoder(use_gpu).predict([["warm up", "warm up"]])
+    except ImportError:
+        print("sentence-transformers not installed. Reranker not loaded.")
+    return model_stats()
+
+
+def model_stats() -> dict:
+    return {key: dict(stats) for key, stats in _load_stats.items()}
@@ -3,14 +3,29 @@ import pytesseract
 from PIL import Image
 from dotenv import load_dotenv
 
+from cache import get_extraction_cache, extraction_key
+from tracing import span
+
 load_dotenv()
 tesseract_cmd = os.getenv("TESSERACT_CMD")
+OCR_LANG = os.getenv("OCR_LANG", "eng")
 
-def ocr_image(image: Image.Image, lang: str = "eng"):
+def ocr_image(image: Image.Image, lang: str = None):
+    lang = lang or OCR_LANG
     try:
+        cache = get_extraction_cache()
+        key = extraction_key(image.tobytes(), f"ocr-{image.mode}-{image.size}", lang=lang)   # pixels, not the encoded file
+        cached = cache.get(key)
+        if cached is not None:
+            return cached.decode("utf-8")
+
         if tesseract_cmd:
             pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
-        txt= pytesseract.image_to_string(image, lang=lang)
+        with span("ocr", width=image.size[0], height=image.size[1], lang=lang) as s:
+            txt= pytesseract.image_to_string(image, lang=lang)
+            s.set(chars=len(txt))
+        if txt.strip():
+            cache.put(key, txt.encode("utf-8"))
         return txt
     except:
         return ""
\ No newline at end of file
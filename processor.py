@@ -1,38 +1,188 @@
 import io
+import os
+import json
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
 from PIL import Image
-from extraction import extract_pdf_text
+from extraction import extract_pdf_pages
 from extraction import extract_docx_text
-from extraction import extract_pptx_text
+from extraction import extract_pptx_slides
 from extraction import extract_html_text
 from extraction import extract_text_file
-from ocr import ocr_image
-
-
-
-def process_all_documents(pdf_docs, docx_docs, pptx_docs, html_docs, txt_docs, image_docs, enable_ocr, poppler_path):
-    all_text = ""
-    if pdf_docs:
-        for pdf in pdf_docs:
-            all_text += extract_pdf_text(pdf, enable_ocr, poppler_path) + "\n\n"
-    if docx_docs:
-        for docx in docx_docs:
-            all_text += extract_docx_text(docx) + "\n\n"
-    if pptx_docs:
-        for pptx in pptx_docs:
-            all_text += extract_pptx_text(pptx) + "\n\n"
-    if html_docs:
-        for html in html_docs:
-            all_text += extract_html_text(html) + "\n\n"
-    if txt_docs:
-        for txt in txt_docs:
-            all_text += extract_text_file(txt) + "\n\n"
-    if image_docs:
-        for img_file in image_docs:
-            try:
-                img = Image.open(io.BytesIO(img_file.read())).convert("RGB")
-                ocr_text = ocr_image(img)
-                if ocr_text:
-                    all_text += ocr_text + "\n\n"
-            except:
-                pass
-    return all_text
\ No newline at end of file
+from extraction import MIN_PAGE_TEXT_CHARS
+import extraction
+from ocr import ocr_image, OCR_LANG
+from cache import get_extraction_cache, extraction_key
+from tracing import span
+
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0")) or (os.cpu_count() or 1)   # 1 = one file at a time
+INGEST_FILE_TIMEOUT = float(os.getenv("INGEST_FILE_TIMEOUT", "300"))   # seconds one file may take before it is skipped
+
+
+def extract_image_text(img_file):
+    try:
+        img = Image.open(io.BytesIO(img_file.read())).convert("RGB")
+        return ocr_image(img) or ""
+    except:
+        return ""
+
+
+def _init_worker(ocr_threads):
+    # Every worker OCRs its own pages, so the cores are split between them instead of each one
+    # starting OCR_WORKERS tesseract processes. Tesseract's own OpenMP threads are capped at one too
+    extraction.OCR_WORKERS = ocr_threads
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def _new_pool(pool_size):
+    # spawn, not fork: a child forked from the streamlit server can inherit a lock (cache, trace log) that
+    # another session's thread holds at that moment and hang on it until the file times out
+    ocr_threads = max(1, min(extraction.OCR_WORKERS, (os.cpu_count() or 1) // pool_size))
+    return ProcessPoolExecutor(max_workers=pool_size, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(ocr_threads,))
+
+
+def _extract_pages(kind, data, enable_ocr, poppler_path):
+    # Runs inside a worker process, so it only gets picklable bytes, not the streamlit upload object.
+    # Returns [(page or slide number / None, text)] so chunks can remember where they came from
+    with span("extract", kind=kind, bytes=len(data), ocr=enable_ocr) as s:
+        pages = _extract_kind(kind, data, enable_ocr, poppler_path)
+        s.set(pages=len(pages), chars=sum(len(t) for _, t in pages))
+    return pages
+
+
+def _extract_kind(kind, data, enable_ocr, poppler_path):
+    file_obj = io.BytesIO(data)
+    if kind == "pdf":
+        return [(n, t) for n, t in enumerate(extract_pdf_pages(data, enable_ocr, poppler_path), 1) if t.strip()]
+    if kind == "pptx":
+        return [(n, t) for n, t in enumerate(extract_pptx_slides(file_obj), 1) if t.strip()]
+    if kind == "docx":
+        text = extract_docx_text(file_obj)
+    elif kind == "html":
+        text = extract_html_text(file_obj)
+    elif kind == "txt":
+        text = extract_text_file(file_obj)
+    elif kind == "image":
+        text = extract_image_text(file_obj)
+    else:
+        text = ""
+    return [(None, text)] if text.strip() else []
+
+
+def read_upload(upload):
+    return upload.getvalue() if hasattr(upload, "getvalue") else upload.read()   # streamlit uploads stay at EOF after a read
+
+
+def _collect_jobs(pdf_docs, docx_docs, pptx_docs, html_docs, txt_docs, image_docs):
+    jobs = []   # (kind, name, upload) in upload order, bytes are only read when the file is processed
+    for kind, files in (("pdf", pdf_docs), ("docx", docx_docs), ("pptx", pptx_docs),
+                        ("html", html_docs), ("txt", txt_docs), ("image", image_docs)):
+        for f in files or []:
+            jobs.append((kind, getattr(f, "name", kind), f))
+    return jobs
+
+
+def _cache_key(kind, data, enable_ocr):
+    if kind == "pdf":
+        return extraction_key(data, kind, ocr=bool(enable_ocr), lang=OCR_LANG, min_page_chars=MIN_PAGE_TEXT_CHARS)
+    if kind == "image":
+        return extraction_key(data, kind, lang=OCR_LANG)
+    return extraction_key(data, kind)
+
+
+def _terminate_pool(executor):
+    # shutdown() can't stop a running task, a worker stuck in poppler/tesseract would live on forever
+    for process in list((getattr(executor, "_processes", None) or {}).values()):
+        if process.is_alive():
+            process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_extracted(jobs, enable_ocr, poppler_path, max_workers=None, file_timeout=None):
+    # Yields (job, pages) in upload order. Only a small window of files is read / in flight at a
+    # time, so memory stays bounded no matter how much was uploaded. Extraction always runs in worker
+    # processes, even for a single file, so a file that hangs can be killed after file_timeout
+    max_workers = max_workers or INGEST_WORKERS
+    file_timeout = file_timeout or INGEST_FILE_TIMEOUT
+
+    cache = get_extraction_cache()
+    executor = None   # started on the first cache miss, fully cached uploads never pay for it
+    pool_size = max(1, min(max_workers, len(jobs)))
+    window = 2 * pool_size if pool_size > 1 else 1
+    cached_files = 0
+
+    def submit(kind, data):
+        nonlocal executor
+        if executor is None:
+            executor = _new_pool(pool_size)
+        return executor.submit(_extract_pages, kind, data, enable_ocr, poppler_path)
+
+    def start(job):
+        # -> (job, cache key, pages if already known, future if extracting in the pool, came from cache)
+        nonlocal cached_files
+        kind, _, upload = job
+        data = read_upload(upload)
+        key = _cache_key(kind, data, enable_ocr)
+        cached = cache.get(key)
+        if cached is not None:
+            cached_files += 1
+            return job, key, [tuple(p) for p in json.loads(cached.decode("utf-8"))], None, True
+        return job, key, [], submit(kind, data), False
+
+    def restart_pool():
+        # Killing the stuck worker breaks the whole pool, files still in flight are resubmitted to a new one
+        nonlocal executor
+        _terminate_pool(executor)
+        executor = None
+        for i, (job, key, pages, future, from_cache) in enumerate(in_flight):
+            if future is not None and not future.done():
+                kind, _, upload = job
+                in_flight[i] = (job, key, pages, submit(kind, read_upload(upload)), from_cache)
+
+    in_flight = deque()
+    try:
+        remaining = iter(jobs)
+        in_flight.extend(start(job) for job in itertools.islice(remaining, window))
+        while in_flight:
+            job, key, pages, future, from_cache = in_flight.popleft()
+            if future is not None:
+                try:
+                    pages = future.result(timeout=file_timeout)
+                except FutureTimeoutError:
+                    print(f"Extraction timed out after {file_timeout}s, skipping: {job[1]}")
+                    restart_pool()
+                except Exception as e:
+                    print(f"Extraction failed for {job[1]}: {e}")
+            if pages and not from_cache:   # empty output is usually a missing tesseract/poppler, don't pin it
+                cache.put(key, json.dumps(pages).encode("utf-8"))
+
+            next_job = next(remaining, None)
+            if next_job is not None:
+                in_flight.append(start(next_job))
+            yield job, pages
+    finally:
+        if executor is not None:
+            if any(future is not None and not future.done() for _, _, _, future, _ in in_flight):
+                _terminate_pool(executor)   # consumer stopped early, nothing is waiting for these
+            else:
+                executor.shutdown(wait=True)
+
+    stats = cache.stats()
+    print(f"Extraction cache: {cached_files}/{len(jobs)} files cached "
+          f"(total {stats.get('hits', 0)} hits, {stats.get('misses', 0)} misses)")
+
+
+def extract_documents(jobs, enable_ocr, poppler_path, max_workers=None, file_timeout=None):
+    return ["\n".join(text for _, text in pages)
+            for _, pages in iter_extracted(jobs, enable_ocr, poppler_path, max_workers, file_timeout)]
+
+
+def process_all_documents(pdf_docs, docx_docs, pptx_docs, html_docs, txt_docs, image_docs, enable_ocr, poppler_path,
+                          max_workers=None, file_timeout=None):
+    jobs = _collect_jobs(pdf_docs, docx_docs, pptx_docs, html_docs, txt_docs, image_docs)
+    texts = extract_documents(jobs, enable_ocr, poppler_path, max_workers, file_timeout)
+    return "\n\n".join(t for t in texts if t)
@@ -4,13 +4,22 @@ os.environ["ANONYMIZED_TELEMETRY"] = "False"
 from langchain_text_splitters import CharacterTextSplitter
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import FastEmbedEmbeddings, SentenceTransformerEmbeddings
 from langchain.chains import ConversationalRetrievalChain
 from langchain.prompts.prompt import PromptTemplate
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
 from typing import List
 import re
+import json
+import time
+import threading
+
+from cache import content_hash, iter_embeddings_with_cache, answer_cache
+from vector_index import NumpyVectorStore, VECTOR_BACKEND, NUMPY_INDEX_MAX_CHUNKS
+from lexical import index_chunks, delete_file_chunks, drop_index
+from hybrid import HybridRetriever, hybrid_search, HYBRID_CANDIDATES
+from models import embedding_model_id, get_embeddings
+from reranker import rerank_documents
+from dedupe import Deduplicator
+from tracing import span, current
 
 # System prompt
 SYSTEM_PROMPT = """You are a helpful AI assistant that answers questions based on the provided documents. 
@@ -34,39 +43,179 @@ Your role is to:
 # )
 
 
-def get_text_chunks(text: str):
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-3-flash-preview")
+
+
+def get_llm(temperature: float = 0.3, **kwargs):
+    # Every chat model comes from here, benchmark.py swaps it for an offline fake
+    return ChatGoogleGenerativeAI(model=LLM_MODEL, temperature=temperature, **kwargs)
+
+
+# Defaults for chunking and retrieval, evaluate.py sweeps them against a labeled question set
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "400"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "80"))
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "8"))   # hybrid candidates handed to the reranker
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "5"))   # chunks that end up in the prompt
+
+
+def get_text_chunks(text: str, chunk_size: int = None, chunk_overlap: int = None):
     splitter = CharacterTextSplitter(
         separator="\n",
-        chunk_size=400,
-        chunk_overlap=80
+        chunk_size=chunk_size or CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
     )
     return splitter.split_text(text)
 
 
-def get_vectorstore(text_chunks, session_id, use_gpu: bool = True):
-    
-    import torch
-    
-    # Check if GPU is actually available
-    has_gpu = torch.cuda.is_available()
-    device = "cuda" if (use_gpu and has_gpu) else "cpu"
-    
-    if use_gpu and not has_gpu:
-        print("GPU was not available. Using CPU instead.")
-    
-    embeddings = SentenceTransformerEmbeddings(
-        model_name="BAAI/bge-small-en-v1.5",
-        model_kwargs={"device": device}
-    )
-    
-    print(f"Embeddings using: {device.upper()}")
+CHROMA_BATCH_SIZE = 1000
+CHROMA_DIR = os.getenv("CHROMA_DIR", "./chroma_db")
+CHROMA_WRITERS = int(os.getenv("CHROMA_WRITERS", "2"))   # concurrent upserts/deletes, the rest wait their turn
+
+# One client per process over ./chroma_db, shared by every streamlit session, plus one
+# langchain handle per session collection
+_chroma = {"client": None, "pid": None}
+_chroma_lock = threading.Lock()
+_chroma_handles = {}
+_chroma_writers = threading.BoundedSemaphore(CHROMA_WRITERS)
+
 
-    return Chroma.from_texts(
-        texts=text_chunks,
-        embedding=embeddings,
+def chroma_client():
+    # Also enough to list / delete collections without loading an embedding model
+    with _chroma_lock:
+        if _chroma["client"] is None or _chroma["pid"] != os.getpid():
+            import chromadb
+            from chromadb.config import Settings
+            _chroma["client"] = chromadb.PersistentClient(path=CHROMA_DIR, settings=Settings(anonymized_telemetry=False))
+            _chroma["pid"] = os.getpid()
+            _chroma_handles.clear()
+        return _chroma["client"]
+
+
+def _open_chroma(session_id, use_gpu: bool = True):
+    client = chroma_client()
+    key = (f"session_{session_id}", use_gpu)
+    vectorstore = _chroma_handles.get(key)
+    if vectorstore is not None:
+        return vectorstore
+
+    vectorstore = Chroma(
+        client=client,
         collection_name=f"session_{session_id}",
-        persist_directory="./chroma_db"
+        embedding_function=get_embeddings(use_gpu),   # used to embed queries, chunks come precomputed
+        collection_metadata={"embedding_model": embedding_model_id()}   # only set when the collection is created
     )
+    built_with = (vectorstore._collection.metadata or {}).get("embedding_model")
+    if built_with and built_with != embedding_model_id():
+        raise ValueError(f"Collection session_{session_id} was embedded with {built_with}, "
+                         f"current backend is {embedding_model_id()}. Start a new session.")
+    with _chroma_lock:
+        return _chroma_handles.setdefault(key, vectorstore)
+
+
+def open_vectorstore(session_id, use_gpu: bool = True):
+    # New sessions start in memory, auto mode moves them to chroma once they get big (see maybe_promote)
+    if VECTOR_BACKEND in ("auto", "numpy"):
+        return NumpyVectorStore(f"session_{session_id}", get_embeddings(use_gpu))
+    return _open_chroma(session_id, use_gpu)
+
+
+def _upsert_vectors(vectorstore, ids, vectors, texts, metadatas):
+    if isinstance(vectorstore, NumpyVectorStore):
+        vectorstore.upsert(ids, vectors, texts, metadatas)
+        return
+    for start in range(0, len(texts), CHROMA_BATCH_SIZE):
+        end = start + CHROMA_BATCH_SIZE
+        with _chroma_writers:   # per batch, so one big upload can't hold every slot until it finishes
+            vectorstore._collection.upsert(
+                ids=ids[start:end],
+                embeddings=vectors[start:end],
+                documents=texts[start:end],
+                metadatas=metadatas[start:end]
+            )
+
+
+def _all_ids(vectorstore):
+    if isinstance(vectorstore, NumpyVectorStore):
+        return vectorstore.all_ids()
+    return vectorstore._collection.get(include=[])["ids"]
+
+
+def maybe_promote(vectorstore, session_id, use_gpu: bool = True):
+    # auto backend: past NUMPY_INDEX_MAX_CHUNKS the session's vectors move to a persistent chroma collection
+    if VECTOR_BACKEND != "auto" or not isinstance(vectorstore, NumpyVectorStore):
+        return vectorstore
+    if len(vectorstore) <= NUMPY_INDEX_MAX_CHUNKS:
+        return vectorstore
+    print(f"Session index has {len(vectorstore)} chunks, moving it to chroma")
+    chroma = _open_chroma(session_id, use_gpu)
+    _upsert_vectors(chroma, *vectorstore.export())
+    return chroma
+
+
+def add_chunks(vectorstore, session_id, text_chunks, metadatas=None, ids=None, use_gpu: bool = True):
+    metadatas = metadatas or [{} for _ in text_chunks]
+    ids = ids or [content_hash(chunk)[:32] for chunk in text_chunks]
+
+    # Identical chunks would collide on their id, so only the first copy is indexed
+    unique = {}
+    for cid, chunk, meta in zip(ids, text_chunks, metadatas):
+        unique.setdefault(cid, (chunk, {**meta, "chunk_id": cid}))
+    chunk_ids = list(unique)
+    text_chunks = [chunk for chunk, _ in unique.values()]
+    metadatas = [meta for _, meta in unique.values()]
+
+    # Only chunks never embedded before (in any session) go through the model, large sets are
+    # spread over the embedding pool and each batch is written as soon as it finishes
+    with span("embed", chunks=len(text_chunks), chars=sum(len(c) for c in text_chunks)) as s:
+        upsert_seconds = 0.0
+        for batch, vectors in iter_embeddings_with_cache(vectorstore.embeddings, embedding_model_id(), text_chunks,
+                                                             use_gpu):
+            start = time.perf_counter()
+            _upsert_vectors(vectorstore, [chunk_ids[i] for i in batch], vectors,
+                            [text_chunks[i] for i in batch], [metadatas[i] for i in batch])
+            upsert_seconds += time.perf_counter() - start
+        s.set(upsert_ms=round(upsert_seconds * 1000, 2))   # included in the span's duration
+
+    # Keyword index is built once here instead of re-tokenizing the corpus on every query
+    collection_name = f"session_{session_id}"
+    with span("lexical_index", chunks=len(chunk_ids)):
+        index_chunks(collection_name, chunk_ids, text_chunks, metadatas)
+
+    # Document set changed, cached answers for it are stale
+    _collection_fingerprints.pop(collection_name, None)
+    answer_cache.invalidate(collection_name)
+    return chunk_ids
+
+
+def remove_chunks(vectorstore, session_id, file_hash: str):
+    collection_name = f"session_{session_id}"
+    if isinstance(vectorstore, NumpyVectorStore):
+        vectorstore.delete_where({"file_hash": file_hash})
+    else:
+        with _chroma_writers:
+            vectorstore._collection.delete(where={"file_hash": file_hash})
+    delete_file_chunks(collection_name, file_hash)
+    _collection_fingerprints.pop(collection_name, None)
+    answer_cache.invalidate(collection_name)
+
+
+def get_vectorstore(text_chunks, session_id, use_gpu: bool = True):
+    vectorstore = open_vectorstore(session_id, use_gpu)
+    dedup = Deduplicator()   # within these chunks only, ingest.add_documents also checks earlier files
+    text_chunks = [chunk for chunk in text_chunks if dedup.admit((content_hash(chunk)[:32], chunk, {}))]
+    add_chunks(vectorstore, session_id, text_chunks, use_gpu=use_gpu)
+    return maybe_promote(vectorstore, session_id, use_gpu)
+
+
+_collection_fingerprints = {}
+
+
+def collection_fingerprint(vectorstore, collection_name: str) -> str:
+    # Chunk ids are content hashes, so the sorted id list identifies the document set
+    if collection_name not in _collection_fingerprints:
+        ids = _all_ids(vectorstore)
+        _collection_fingerprints[collection_name] = content_hash(*sorted(ids))
+    return _collection_fingerprints[collection_name]
 
 
 #  Query decompo.. - breaks complex queries into sub-queries
@@ -80,10 +229,7 @@ def decompose_query(question: str) -> List[str]:
     if not (is_long and has_multiple_parts):
         return [question]  # original
     
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-3-flash-preview",
-        temperature=0.2
-    )
+    llm = get_llm(temperature=0.2)
     
     prompt = f"""Break this complex question into 2-5 simpler sub-questions that can be answered independently.
                 Each sub-question should target a specific aspect of the original question.
@@ -98,7 +244,9 @@ def decompose_query(question: str) -> List[str]:
                 Sub-questions:"""
     
     try:
-        response = llm.invoke(prompt)
+        with span("llm.decompose", prompt_chars=len(prompt)) as s:
+            response = llm.invoke(prompt)
+            s.set(response_chars=len(response.content))
         sub_queries = response.content.strip().split('\n')
         sub_queries = [q.strip() for q in sub_queries if q.strip() and q[0].isdigit()]
         sub_queries = [re.sub(r'^\d+\.\s*', '', q) for q in sub_queries] #extra cleaning
@@ -116,64 +264,36 @@ def decompose_query(question: str) -> List[str]:
 
 #    Hybrid Semantic+BM25+Reranking
 
-def create_hybrid_retriever(vectorstore, text_chunks, k: int = 8):
+def create_hybrid_retriever(vectorstore, session_id, k: int = RETRIEVAL_K, filters=None):
     #k: no of docs to retrieve
-
-    semantic_retriever = vectorstore.as_retriever(
-        search_kwargs={"k": k}
-    )
-    
-    bm25_retriever = BM25Retriever.from_texts(text_chunks)
-    bm25_retriever.k = k
-    
-    # Ensemble
-    hybrid_retriever = EnsembleRetriever(
-        retrievers=[semantic_retriever, bm25_retriever],
-        weights=[0.6, 0.4]
+    # semantic + persistent FTS5/BM25 index, fused by chunk id (see hybrid.py)
+    hybrid_retriever = HybridRetriever(
+        vectorstore=vectorstore,
+        collection_name=f"session_{session_id}",
+        k=k,
+        filters=filters
     )
     
     print("Hybrid retriever created!!")
     return hybrid_retriever
 
 
-# rerankings
+def retrieve_for_sub_queries(vectorstore, session_id, sub_queries, k: int = 5, filters=None):
+    # All sub-queries are embedded in one batched forward pass, then every vector and
+    # keyword lookup runs concurrently, so 5 sub-questions cost about as much as 1
+    for i, sq in enumerate(sub_queries, 1):
+        print(f"  {i}. {sq}")
 
-def rerank_documents(docs, query: str, top_k: int = 5):
-  
-    try:
-        from sentence_transformers import CrossEncoder
-        
-        reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')# Lightweight cross-encoder for reranking
-        doc_texts = [doc.page_content for doc in docs]
-        pairs = [[query, doc_text] for doc_text in doc_texts]
-        scores = reranker.predict(pairs)
-        
-        # Sort
-        scored_docs = list(zip(docs, scores))
-        scored_docs.sort(key=lambda x: x[1], reverse=True)
-        
-        reranked = [doc for doc, score in scored_docs[:top_k]]
-        print(f"Reranked {len(docs)} docs → top {top_k}")
-        return reranked
-        
-    except ImportError:
-        print("sentence-transformers not installed. Skipping reranking.")
-        print(" Install: pip install sentence-transformers")
-        return docs[:top_k]
-    except Exception as e:
-        print(f"Reranking error: {e}")
-        return docs[:top_k]
+    # k per sub-query, so the reranker still sees every sub-question's best chunks
+    return hybrid_search(vectorstore, f"session_{session_id}", sub_queries, k=k * len(sub_queries), filters=filters,
+                         candidates=max(k, HYBRID_CANDIDATES))
 
 
-def get_conversation_chain(vectorstore, text_chunks):
+def get_conversation_chain(vectorstore, session_id):
     
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-3-flash-preview",
-        temperature=0.3,
-        system_prompt=SYSTEM_PROMPT
-    )
+    llm = get_llm(temperature=0.3, system_prompt=SYSTEM_PROMPT)
 
-    hybrid_retriever = create_hybrid_retriever(vectorstore, text_chunks, k=8)
+    hybrid_retriever = create_hybrid_retriever(vectorstore, session_id, k=RETRIEVAL_K)
 
     return ConversationalRetrievalChain.from_llm(
         llm=llm,
@@ -183,95 +303,128 @@ def get_conversation_chain(vectorstore, text_chunks):
     )
 
 
-# for complex queries like those broke into subqueries..
+def build_answer_prompt(query: str, docs, chat_history=None) -> str:
+    context = "\n\n".join([doc.page_content for doc in docs])
 
-def process_query_with_hybrid_search(conversation_chain, query: str, chat_history, 
-                                     vectorstore, text_chunks, use_reranking: bool = True):
-   
-    sub_queries = decompose_query(query)
-    
-    if len(sub_queries) > 1:
-        # Multiqueries
-        print(f"Processing {len(sub_queries)} sub-queries...")
-        
-        all_docs = []
-        hybrid_retriever = create_hybrid_retriever(vectorstore, text_chunks, k=5)
-        
-        for i, sq in enumerate(sub_queries, 1):
-            print(f"  {i}. {sq}")
-            docs = hybrid_retriever.get_relevant_documents(sq)
-            all_docs.extend(docs)
-        
-        seen = set()# Remove duplicates
-        unique_docs = []
-        for doc in all_docs:
-            if doc.page_content not in seen:
-                unique_docs.append(doc)
-                seen.add(doc.page_content)
-        
-        if use_reranking and len(unique_docs) > 5:
-            final_docs = rerank_documents(unique_docs, query, top_k=5)
-        else:
-            final_docs = unique_docs[:5]
-        
-        context = "\n\n".join([doc.page_content for doc in final_docs])
-        
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-3-flash-preview",
-            temperature=0.3
-        )
-        
-        answer_prompt = f"""Based on the following context, answer this question comprehensively:
+    # Chat history goes straight into the prompt, no separate condense-question call
+    history = ""
+    if chat_history:
+        history = "\n".join(f"Human: {q}\nAssistant: {a}" for q, a in chat_history)
+        history = f"""
+                                Conversation so far:
+                                {history}
+"""
 
+    return f"""{SYSTEM_PROMPT}
+
+                                Based on the following context, answer this question comprehensively:
+{history}
                                 Question: {query}
 
                                 Context:
                                 {context}
 
                                 Provide a detailed answer:"""
-        
-        response = llm.invoke(answer_prompt)
-        
-        return {
-            "answer": response.content,
-            "source_documents": final_docs,
-            "sub_queries": sub_queries
-        }
-    
 
 
+# for complex queries like those broke into subqueries..
 
+def _stream_tokens(llm, prompt, parent=None):
+    # Consumed after process_query_with_hybrid_search returned, parent keeps it in the query's trace
+    with span("llm.answer", parent=parent, prompt_chars=len(prompt), stream=True) as s:
+        first_token, response_chars = None, 0
+        start = time.perf_counter()
+        for chunk in llm.stream(prompt):
+            if chunk.content:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                response_chars += len(chunk.content)
+                yield chunk.content
+        s.set(response_chars=response_chars,
+              first_token_ms=round(first_token * 1000, 2) if first_token is not None else None)
+
+
+def _stream_and_cache(tokens, scope, query_vector, result):
+    parts = []
+    for token in tokens:
+        parts.append(token)
+        yield token
+    # Only a fully streamed answer is cached
+    answer_cache.store(scope, query_vector, {**result, "answer": "".join(parts)})
+
+
+def process_query_with_hybrid_search(query: str, chat_history, vectorstore, session_id,
+                                     use_reranking: bool = True, top_k: int = RERANK_TOP_K, stream: bool = False,
+                                     filters=None):
+    with span("query", query_chars=len(query), stream=stream, reranking=use_reranking) as s:
+        result = _answer_query(query, chat_history, vectorstore, session_id, use_reranking, top_k, stream, filters)
+        s.set(cached=result.get("cached", False), sources=len(result["source_documents"]))
+    return result
+
+
+def _answer_query(query, chat_history, vectorstore, session_id, use_reranking, top_k, stream, filters):
+    # retrieve -> rerank -> answer in one pass, the reranked docs are exactly what the LLM sees
+
+    # Same documents + conversation so far + a near-identical question -> reuse the earlier answer, no LLM call
+    # at all. The history goes into the prompt, so "what about the second one?" must not match across chats
+    collection_name = f"session_{session_id}"
+    scope = (collection_name, collection_fingerprint(vectorstore, collection_name), use_reranking, top_k,
+             json.dumps(filters or {}, sort_keys=True, default=list), content_hash(json.dumps(chat_history or [])))
+    query_vector = vectorstore.embeddings.embed_query(query)
+    cached = answer_cache.lookup(scope, query_vector)
+    if cached is not None:
+        print("Answer cache hit")
+        return {**cached, "cached": True}
+   
+    sub_queries = decompose_query(query)
+    
+    if len(sub_queries) > 1:
+        # Multiqueries
+        print(f"Processing {len(sub_queries)} sub-queries...")
+        
+        docs = retrieve_for_sub_queries(vectorstore, session_id, sub_queries, k=5, filters=filters)
     else:
         # Simple query
-        hybrid_retriever = create_hybrid_retriever(vectorstore, text_chunks, k=8)
-        docs = hybrid_retriever.get_relevant_documents(query)
-        
-        if use_reranking:
-            docs = rerank_documents(docs, query, top_k=5)
-        
-        result = conversation_chain({"question": query, "chat_history": chat_history})
-        result["sub_queries"] = None
-        return result
+        # query vector from the cache lookup is reused, no second embedding pass
+        docs = hybrid_search(vectorstore, collection_name, [query], k=RETRIEVAL_K, filters=filters, query_vectors=[query_vector])
+
+    if use_reranking and len(docs) > top_k:
+        final_docs = rerank_documents(docs, query, top_k=top_k)
+    else:
+        final_docs = docs[:top_k]
+
+    llm = get_llm(temperature=0.3)
+    answer_prompt = build_answer_prompt(query, final_docs, chat_history)
+    result = {
+        "source_documents": final_docs,
+        "sub_queries": sub_queries if len(sub_queries) > 1 else None
+    }
+
+    if stream:
+        # caller renders tokens as they arrive
+        result["answer_stream"] = _stream_and_cache(_stream_tokens(llm, answer_prompt, current()), scope, query_vector,
+                                                    dict(result))
+    else:
+        with span("llm.answer", prompt_chars=len(answer_prompt), stream=False) as s:
+            result["answer"] = llm.invoke(answer_prompt).content
+            s.set(response_chars=len(result["answer"]))
+        answer_cache.store(scope, query_vector, dict(result))
+    return result
 
 
 def clear_chroma_collection(session_id, use_gpu: bool = True):
-   
-    import torch
-    
+    # use_gpu is unused, deleting a collection doesn't need the embedding model
     try:
-        has_gpu = torch.cuda.is_available()
-        device = "cuda" if (has_gpu) else "cpu"
-        print(device)
-        embeddings = SentenceTransformerEmbeddings(
-            model_name="BAAI/bge-small-en-v1.5",
-            model_kwargs={"device": device}
-        )
-        vs = Chroma(
-            collection_name=f"session_{session_id}",
-            embedding_function=embeddings,
-            persist_directory="./chroma_db"
-        )
-        vs.delete_collection()
+        client = chroma_client()
+        with _chroma_lock:
+            for key in [key for key in _chroma_handles if key[0] == f"session_{session_id}"]:
+                del _chroma_handles[key]
+        if f"session_{session_id}" in [c.name for c in client.list_collections()]:
+            with _chroma_writers:
+                client.delete_collection(f"session_{session_id}")   # sessions on the in-memory index never created one
+        drop_index(f"session_{session_id}")
+        _collection_fingerprints.pop(f"session_{session_id}", None)
+        answer_cache.invalidate(f"session_{session_id}")
         return True
     except Exception as e:
         print("Chroma cleanup error:", e)
@@ -279,10 +432,7 @@ def clear_chroma_collection(session_id, use_gpu: bool = True):
 
 
 def generate_followup_questions(question: str, answer: str) -> list:
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-3-flash-preview",
-        temperature=0.5
-    )
+    llm = get_llm(temperature=0.5)
     
     prompt = f"""Based on this Q&A, generate 3 concise follow-up questions that would deepen understanding.
                 Each question should be 1 line, practical, and relevant.
@@ -293,7 +443,9 @@ def generate_followup_questions(question: str, answer: str) -> list:
                 Generate 3 follow-up questions (one per line, numbered):"""
     
     try:
-        response = llm.invoke(prompt)
+        with span("llm.followups", prompt_chars=len(prompt)) as s:
+            response = llm.invoke(prompt)
+            s.set(response_chars=len(response.content))
         questions = response.content.strip().split('\n')
         questions = [q.strip() for q in questions if q.strip() and q[0].isdigit()]
         questions = [q.split('. ', 1)[-1] if '. ' in q else q for q in questions]
@@ -305,10 +457,7 @@ def generate_followup_questions(question: str, answer: str) -> list:
 
 def summarize_documents(vectorstore, summary_type: str = "brief") -> str:
     
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-3-flash-preview",
-        temperature=0.3
-    )
+    llm = get_llm(temperature=0.3)
 
     semantic_queries = [   # Multiquery semantic search captures different document aspects
         "main topics and key concepts",
@@ -355,7 +504,9 @@ def summarize_documents(vectorstore, summary_type: str = "brief") -> str:
             Provide the summary:"""
     
     try:
-        response = llm.invoke(prompt)
+        with span("llm.summary", prompt_chars=len(prompt), chunks=len(all_chunks[:20])) as s:
+            response = llm.invoke(prompt)
+            s.set(response_chars=len(response.content))
         return response.content
     except Exception as e:
         print(f"Error summarizing: {e}")
@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+
+from cache import content_hash
+from models import get_cross_encoder, reranker_model_id
+from tracing import span
+
+
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "20000"))   # (query, chunk) scores kept in memory
+
+
+class ScoreCache:
+    # LRU of cross-encoder scores, follow-ups and repeated questions mostly rerank pairs seen before
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    found[key] = self._scores[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        with self._lock:
+            for key, score in items:
+                self._scores[key] = score
+                self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._scores.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "entries": len(self._scores)}
+
+
+score_cache = ScoreCache(RERANK_CACHE_SIZE)
+
+
+def score_pairs(query: str, texts) -> list:
+    # Scores depend on the model, backend and truncation length too, so those are part of the query key
+    query_key = content_hash(reranker_model_id(), query)
+    keys = [(query_key, content_hash(text)) for text in texts]
+    found = score_cache.get_many(keys)
+
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    if missing:
+        reranker = get_cross_encoder()   # shared, loaded once per process
+        scores = reranker.predict([[query, texts[i]] for i in missing],
+                                  batch_size=RERANK_BATCH_SIZE, show_progress_bar=False)
+        new_scores = [(keys[i], float(score)) for i, score in zip(missing, scores)]
+        score_cache.put_many(new_scores)
+        found.update(new_scores)
+    return [found[key] for key in keys]
+
+
+def rerank_documents(docs, query: str, top_k: int = 5):
+  
+    try:
+        with span("rerank", docs=len(docs), top_k=top_k) as s:
+            hits_before = score_cache.hits
+            scores = score_pairs(query, [doc.page_content for doc in docs])
+            s.set(cached_scores=score_cache.hits - hits_before)
+        
+        # Sort
+        scored_docs = list(zip(docs, scores))
+        scored_docs.sort(key=lambda x: x[1], reverse=True)
+        
+        reranked = [doc for doc, score in scored_docs[:top_k]]
+        print(f"Reranked {len(docs)} docs → top {top_k}")
+        return reranked
+        
+    except ImportError:
+        print("sentence-transformers not installed. Skipping reranking.")
+        print(" Install: pip install sentence-transformers")
+        return docs[:top_k]
+    except Exception as e:
+        print(f"Reranking error: {e}")
+        return docs[:top_k]
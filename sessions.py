@@ -0,0 +1,173 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import threading
+
+from ingest import MANIFEST_DB_PATH, forget_session, indexed_collections
+from rag import CHROMA_DIR, chroma_client, clear_chroma_collection
+from lexical import LEXICAL_DB_PATH
+from dedupe import DEDUPE_DB_PATH
+
+
+# Sessions that nobody has touched for SESSION_TTL_HOURS (tab closed, browser gone) are deleted
+# together with their chroma collection, keyword index, manifest and dedupe rows.
+SESSIONS_DB_PATH = os.getenv("SESSIONS_DB_PATH", "./chroma_db/sessions.sqlite")
+SESSION_TTL_HOURS = float(os.getenv("SESSION_TTL_HOURS", "72"))
+SESSION_REAP_INTERVAL = int(os.getenv("SESSION_REAP_INTERVAL", "3600"))   # seconds between reap + compaction runs
+TOUCH_INTERVAL = 60   # last_access is written at most once a minute per session
+
+_UUID_DIR = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+_local = threading.local()
+_last_touch = {}
+_reap_lock = threading.Lock()
+_last_reap = 0.0
+
+
+def _connect():
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        os.makedirs(os.path.dirname(SESSIONS_DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(SESSIONS_DB_PATH, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (collection TEXT PRIMARY KEY, created_at REAL, last_access REAL)")
+        conn.commit()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def touch(session_id):
+    collection_name = f"session_{session_id}"
+    now = time.time()
+    if now - _last_touch.get(collection_name, 0.0) < TOUCH_INTERVAL:
+        return
+    _last_touch[collection_name] = now
+    conn = _connect()
+    with conn:
+        conn.execute("INSERT INTO sessions VALUES (?, ?, ?) ON CONFLICT(collection) DO UPDATE SET last_access = ?",
+                     (collection_name, now, now, now))
+
+
+def delete_session(session_id):
+    # Model-free: chroma collection, keyword index, manifest, dedupe rows and the access record
+    collection_name = f"session_{session_id}"
+    clear_chroma_collection(session_id)
+    forget_session(session_id)
+    _last_touch.pop(collection_name, None)
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM sessions WHERE collection = ?", (collection_name,))
+
+
+def _known_collections():
+    names = set(indexed_collections())
+    try:
+        names.update(c.name for c in chroma_client().list_collections() if c.name.startswith("session_"))
+    except Exception as e:
+        print(f"Session listing error: {e}")
+    return names
+
+
+def reap_expired(ttl_hours: float = SESSION_TTL_HOURS) -> list:
+    conn = _connect()
+    now = time.time()
+    # Collections from before access tracking (or from a crashed process) start their TTL now
+    tracked = {row[0] for row in conn.execute("SELECT collection FROM sessions")}
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?)",
+                         [(name, now, now) for name in _known_collections() - tracked])
+
+    expired = [row[0] for row in conn.execute(
+        "SELECT collection FROM sessions WHERE last_access < ?", (now - ttl_hours * 3600,))]
+    for collection_name in expired:
+        delete_session(collection_name[len("session_"):])
+    if expired:
+        print(f"Reaped {len(expired)} expired sessions")
+    return expired
+
+
+def _live_segment_ids(chroma_sqlite):
+    conn = sqlite3.connect(chroma_sqlite, timeout=30)
+    try:
+        return {row[0] for row in conn.execute("SELECT id FROM segments")}
+    finally:
+        conn.close()
+
+
+def compact():
+    # Deleted collections can leave their HNSW segment directories behind, and none of the sqlite
+    # files shrink on their own
+    chroma_sqlite = os.path.join(CHROMA_DIR, "chroma.sqlite3")
+    removed = 0
+    if os.path.exists(chroma_sqlite):
+        live = _live_segment_ids(chroma_sqlite)
+        candidates = [e for e in os.listdir(CHROMA_DIR)
+                      if _UUID_DIR.match(e) and os.path.isdir(os.path.join(CHROMA_DIR, e)) and e not in live]
+        # segment rows are written before their directories, a second read covers collections created meanwhile
+        live = _live_segment_ids(chroma_sqlite)
+        for entry in candidates:
+            if entry not in live:
+                shutil.rmtree(os.path.join(CHROMA_DIR, entry), ignore_errors=True)
+                removed += 1
+
+    for db_path in (chroma_sqlite, LEXICAL_DB_PATH, MANIFEST_DB_PATH, DEDUPE_DB_PATH, SESSIONS_DB_PATH):
+        if not os.path.exists(db_path):
+            continue
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.OperationalError as e:   # busy with a writer, next run gets it
+            print(f"VACUUM {db_path} skipped: {e}")
+        finally:
+            conn.close()
+    print(f"Compaction: {removed} orphaned segment directories removed")
+    return removed
+
+
+def _dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def disk_usage() -> dict:
+    # collection -> {"vector_bytes": HNSW segment files, "chunks": indexed chunks}. Rows in the shared
+    # sqlite files aren't split per session, total_bytes covers everything under CHROMA_DIR
+    usage = {name: {"vector_bytes": 0, "chunks": chunks or 0} for name, chunks in indexed_collections().items()}
+    chroma_sqlite = os.path.join(CHROMA_DIR, "chroma.sqlite3")
+    if os.path.exists(chroma_sqlite):
+        conn = sqlite3.connect(chroma_sqlite, timeout=30)
+        try:
+            rows = conn.execute(
+                "SELECT c.name, s.id FROM segments s JOIN collections c ON s.collection = c.id").fetchall()
+        finally:
+            conn.close()
+        for name, segment_id in rows:
+            entry = usage.setdefault(name, {"vector_bytes": 0, "chunks": 0})
+            entry["vector_bytes"] += _dir_bytes(os.path.join(CHROMA_DIR, segment_id))
+    return {"sessions": usage, "total_bytes": _dir_bytes(CHROMA_DIR)}
+
+
+def maybe_reap():
+    # Called on every script run, does the work in the background at most once per SESSION_REAP_INTERVAL
+    global _last_reap
+    with _reap_lock:
+        if time.time() - _last_reap < SESSION_REAP_INTERVAL:
+            return
+        _last_reap = time.time()
+
+    def run():
+        try:
+            reap_expired()
+            compact()
+        except Exception as e:
+            print(f"Session cleanup error: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
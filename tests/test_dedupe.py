@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+
+import dedupe
+
+
+COLLECTION = "session_test"
+TEXT = "The quarterly report lists revenue, operating costs and the outlook for the next two quarters."
+
+
+@pytest.fixture(autouse=True)
+def dedupe_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(dedupe, "DEDUPE_DB_PATH", str(tmp_path / "dedupe.sqlite"))
+    monkeypatch.setattr(dedupe, "_local", threading.local())   # no connection to the real database
+    monkeypatch.setattr(dedupe, "DEDUPE_ENABLED", True)
+
+
+def record(chunk_id, file_hash, text=TEXT):
+    return chunk_id, text, {"file_hash": file_hash}
+
+
+def test_duplicate_is_dropped_across_runs():
+    first = dedupe.Deduplicator(COLLECTION)
+    assert first.admit(record("a1", "file-a"))
+    first.commit()
+
+    second = dedupe.Deduplicator(COLLECTION)
+    assert not second.admit(record("b1", "file-b", TEXT.upper()))
+    assert second.removed == 1
+
+
+def test_removing_a_file_restores_its_duplicates():
+    dedup = dedupe.Deduplicator(COLLECTION)
+    assert dedup.admit(record("a1", "file-a"))
+    assert not dedup.admit(record("b1", "file-b"))
+    dedup.commit()
+
+    dedup, restored = dedupe.readmit_released(COLLECTION, "file-a")
+    assert [chunk_id for chunk_id, _, _ in restored] == ["b1"]
+    dedup.commit()
+
+    # The restored chunk now stands in for the removed one
+    later = dedupe.Deduplicator(COLLECTION)
+    assert not later.admit(record("c1", "file-c"))
+
+
+def test_restored_chunks_deduplicate_among_themselves():
+    dedup = dedupe.Deduplicator(COLLECTION)
+    assert dedup.admit(record("a1", "file-a"))
+    assert not dedup.admit(record("b1", "file-b"))
+    assert not dedup.admit(record("c1", "file-c"))
+    dedup.commit()
+
+    dedup, restored = dedupe.readmit_released(COLLECTION, "file-a")
+    assert len(restored) == 1
+    dedup.commit()
+
+
+LONG_TEXT = ("Employees may work remotely up to three days a week after their probation period ends, provided "
+             "their manager approves a written schedule in advance. Remote days must be recorded in the attendance "
+             "system by Friday of the previous week. Equipment issued for home use remains company property and "
+             "has to be returned within five working days of leaving the company.")
+
+
+def test_one_word_edit_is_a_near_duplicate():
+    edited = LONG_TEXT.replace("three days", "two days")
+    assert dedupe.minhash_signature(dedupe._normalize(LONG_TEXT)).size == dedupe.MINHASH_PERM
+
+    dedup = dedupe.Deduplicator(COLLECTION)
+    assert dedup.admit(record("a1", "file-a", LONG_TEXT))
+    assert not dedup.admit(record("b1", "file-b", edited))
+
+
+def test_low_overlap_chunk_is_kept():
+    # Shares its opening sentence with LONG_TEXT, the rest is different
+    other = ("Employees may work remotely up to three days a week after their probation period ends. Travel "
+             "expenses are reimbursed against receipts submitted within thirty days, and flights longer than six "
+             "hours may be booked in premium economy. Hotel stays above the city rate need written approval.")
+
+    dedup = dedupe.Deduplicator(COLLECTION)
+    assert dedup.admit(record("a1", "file-a", LONG_TEXT))
+    assert dedup.admit(record("b1", "file-b", other))
+
+
+def test_signature_estimates_similarity():
+    # With independent permutations the estimate is a fraction, not only 0 or 1
+    words = LONG_TEXT.split()
+    half = " ".join(words[:len(words) // 2] + ["unrelated"] * 3 + [w[::-1] for w in words[len(words) // 2:]])
+    a = dedupe.minhash_signature(dedupe._normalize(LONG_TEXT))
+    b = dedupe.minhash_signature(dedupe._normalize(half))
+    assert 0.2 < (a == b).mean() < 0.8
+
+
+def test_interrupted_run_can_be_redone():
+    other = LONG_TEXT.replace("Employees", "Contractors").replace("company", "client")
+    dedup = dedupe.Deduplicator(COLLECTION)
+    assert dedup.admit(record("a1", "file-a"))
+    assert dedup.admit(record("a2", "file-a", other))
+    assert not dedup.admit(record("b1", "file-b", other))
+    dedup.commit(["a1"])   # a2 was never indexed, the run died here
+
+    # The retry indexes file-a again: a1 matches only itself, a2 has no signature yet
+    retry = dedupe.Deduplicator(COLLECTION)
+    assert retry.admit(record("a1", "file-a"))
+    assert retry.admit(record("a2", "file-a", other))
+    assert not retry.admit(record("a1", "file-a"))   # same chunk twice in one run
+    assert retry.removed == 0
+
+
+def test_dropped_chunk_waits_for_the_chunk_it_duplicates():
+    dedup = dedupe.Deduplicator(COLLECTION)
+    assert dedup.admit(record("a1", "file-a"))
+    assert not dedup.admit(record("b1", "file-b"))
+    dedup.commit([])
+    assert dedupe.release_file(COLLECTION, "file-a") == []
+
+    dedup.commit(["a1"])
+    assert [chunk_id for chunk_id, _, _ in dedupe.release_file(COLLECTION, "file-a")] == ["b1"]
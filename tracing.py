@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+# Stage-level spans for ingestion and querying: duration, counts, prompt/response sizes and RSS deltas,
+# one JSON object per line. Spans opened inside another span share its trace id.
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "./logs/trace.jsonl")
+TRACE_LOG_MAX_MB = float(os.getenv("TRACE_LOG_MAX_MB", "50"))   # rotated to .1 past this
+
+_current = contextvars.ContextVar("trace_span", default=None)   # (trace id, span id)
+_write_lock = threading.Lock()
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except Exception:
+        pass
+    try:
+        import resource   # not on windows
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+    except Exception:
+        return None
+
+
+class Span:
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+def current():
+    # Pass to span(parent=...) when the work continues after this span closed, e.g. a streamed answer
+    return _current.get()
+
+
+def _write(record: dict):
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        try:
+            os.makedirs(os.path.dirname(TRACE_LOG_PATH) or ".", exist_ok=True)
+            if os.path.exists(TRACE_LOG_PATH) and os.path.getsize(TRACE_LOG_PATH) > TRACE_LOG_MAX_MB * 1024 * 1024:
+                os.replace(TRACE_LOG_PATH, TRACE_LOG_PATH + ".1")
+            with open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:   # single appends, worker processes can share the file
+                f.write(line)
+        except OSError as e:
+            print(f"Trace write error: {e}")
+
+
+@contextmanager
+def span(name: str, parent=None, **attrs):
+    record = Span(name, dict(attrs))
+    if not TRACE_ENABLED:
+        yield record
+        return
+
+    parent = parent or _current.get()
+    trace_id = parent[0] if parent else uuid.uuid4().hex[:16]
+    span_id = uuid.uuid4().hex[:16]
+    token = _current.set((trace_id, span_id))
+    rss_before = rss_mb()
+    started = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield record
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        try:
+            _current.reset(token)
+        except ValueError:   # generator span closed from another context (abandoned stream)
+            pass
+        rss_after = rss_mb()
+        _write({
+            "name": name,
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent[1] if parent else None,
+            "start": round(started, 3),
+            "duration_ms": round(duration * 1000, 2),
+            "rss_delta_mb": round(rss_after - rss_before, 1) if rss_before is not None and rss_after is not None else None,
+            "pid": os.getpid(),
+            "error": error,
+            **record.attrs,
+        })
+
+
+def read_spans(limit: int = 2000) -> list:
+    # Last `limit` spans from the log, oldest first
+    try:
+        with open(TRACE_LOG_PATH, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            offset = max(0, f.tell() - 4 * 1024 * 1024)
+            f.seek(offset)
+            lines = f.read().decode("utf-8", errors="ignore").splitlines()
+    except OSError:
+        return []
+    if offset:
+        lines = lines[1:]   # started mid-line
+    spans = []
+    for line in lines[-limit:]:
+        try:
+            spans.append(json.loads(line))
+        except ValueError:
+            pass
+    return spans
+
+
+def stage_summary(spans) -> list:
+    # Per span name: count, p50 / p95 / max duration
+    durations = {}
+    for s in spans:
+        durations.setdefault(s["name"], []).append(s["duration_ms"])
+    summary = []
+    for name, values in sorted(durations.items()):
+        values.sort()
+        summary.append({
+            "stage": name,
+            "count": len(values),
+            "p50_ms": values[len(values) // 2],
+            "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+            "max_ms": values[-1],
+        })
+    return summary
@@ -0,0 +1,211 @@
+import os
+import threading
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+
+# Small sessions don't need a persistent chroma collection: a few thousand 384-dim vectors fit in one
+# contiguous matrix and exact top-k is a single matrix-vector product.
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "auto")   # auto | numpy | chroma
+NUMPY_INDEX_MAX_CHUNKS = int(os.getenv("NUMPY_INDEX_MAX_CHUNKS", "20000"))   # auto mode moves to chroma above this
+NUMPY_INDEX_QUANTIZE = os.getenv("NUMPY_INDEX_QUANTIZE", "0") == "1"   # int8 rows, 4x less memory
+QUANTIZED_SCORE_BLOCK = 512   # int8 rows converted to float32 at a time when scoring
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _matches(metadata, where) -> bool:
+    # Subset of chroma's where syntax, enough for hybrid.build_chroma_filter / remove_chunks
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(_matches(metadata, c) for c in cond):
+                return False
+        elif key == "$or":
+            if not any(_matches(metadata, c) for c in cond):
+                return False
+        elif isinstance(cond, dict):
+            value = metadata.get(key)
+            for op, expected in cond.items():
+                if op == "$eq" and value != expected:
+                    return False
+                if op == "$ne" and value == expected:
+                    return False
+                if op == "$in" and value not in expected:
+                    return False
+                if op == "$nin" and value in expected:
+                    return False
+                if op in ("$gt", "$gte", "$lt", "$lte"):
+                    if value is None:
+                        return False
+                    if op == "$gt" and not value > expected:
+                        return False
+                    if op == "$gte" and not value >= expected:
+                        return False
+                    if op == "$lt" and not value < expected:
+                        return False
+                    if op == "$lte" and not value <= expected:
+                        return False
+        elif metadata.get(key) != cond:
+            return False
+    return True
+
+
+class NumpyVectorStore(VectorStore):
+
+    def __init__(self, collection_name: str, embedding, quantize: bool = NUMPY_INDEX_QUANTIZE, dim: int = 384):
+        self.collection_name = collection_name
+        self._embedding = embedding
+        self.quantize = quantize
+        self._lock = threading.Lock()
+        self._ids = []
+        self._texts = []
+        self._metadatas = []
+        self._positions = {}   # id -> row
+        self._size = 0
+        self._dim = dim
+        self._matrix = np.zeros((0, dim), dtype=np.int8 if quantize else np.float32)
+        self._scales = np.zeros(0, dtype=np.float32)   # per-row dequantization scale when quantized
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self, needed):
+        capacity = self._matrix.shape[0]
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, 2 * capacity, 1024)   # amortized appends, matrix stays contiguous
+        matrix = np.zeros((new_capacity, self._dim), dtype=self._matrix.dtype)
+        matrix[:self._size] = self._matrix[:self._size]
+        scales = np.zeros(new_capacity, dtype=np.float32)
+        scales[:self._size] = self._scales[:self._size]
+        self._matrix, self._scales = matrix, scales
+
+    def _encode(self, vectors):
+        vectors = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+        if not self.quantize:
+            return vectors, np.ones(len(vectors), dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def upsert(self, ids, vectors, texts, metadatas=None):
+        metadatas = metadatas or [{} for _ in ids]
+        if len(ids) and self._dim != len(vectors[0]):
+            if self._size:
+                raise ValueError(f"Vector size {len(vectors[0])} does not match index size {self._dim}")
+            self._dim = len(vectors[0])
+            self._matrix = np.zeros((0, self._dim), dtype=self._matrix.dtype)
+        rows, scales = self._encode(vectors)
+        with self._lock:
+            self._grow(self._size + len(ids))
+            for cid, row, scale, text, meta in zip(ids, rows, scales, texts, metadatas):
+                pos = self._positions.get(cid)
+                if pos is None:
+                    pos = self._size
+                    self._positions[cid] = pos
+                    self._ids.append(cid)
+                    self._texts.append(text)
+                    self._metadatas.append(meta)
+                    self._size += 1
+                else:
+                    self._texts[pos] = text
+                    self._metadatas[pos] = meta
+                self._matrix[pos] = row
+                self._scales[pos] = scale
+
+    def delete_where(self, where: dict):
+        with self._lock:
+            keep = [i for i, meta in enumerate(self._metadatas) if not _matches(meta, where)]
+            if len(keep) == self._size:
+                return
+            self._matrix = np.ascontiguousarray(self._matrix[keep])
+            self._scales = self._scales[keep]
+            self._ids = [self._ids[i] for i in keep]
+            self._texts = [self._texts[i] for i in keep]
+            self._metadatas = [self._metadatas[i] for i in keep]
+            self._positions = {cid: i for i, cid in enumerate(self._ids)}
+            self._size = len(keep)
+
+    def all_ids(self) -> List[str]:
+        return list(self._ids)
+
+    def export(self):
+        # (ids, dequantized vectors, texts, metadatas), used when a session outgrows this index and moves to chroma
+        with self._lock:
+            vectors = self._matrix[:self._size].astype(np.float32) * self._scales[:self._size, None]
+            return list(self._ids), vectors.tolist(), list(self._texts), [dict(m) for m in self._metadatas]
+
+    def stats(self) -> dict:
+        return {"chunks": self._size, "bytes": int(self._matrix[:self._size].nbytes), "quantized": self.quantize}
+
+    def _dot(self, query):
+        if not self.quantize:
+            return self._matrix[:self._size] @ query
+        # int8 @ float32 would make a float32 copy of the whole matrix on every query, converting a
+        # block at a time into one reused buffer keeps the saving and is faster too
+        scores = np.empty(self._size, dtype=np.float32)
+        buffer = np.empty((min(QUANTIZED_SCORE_BLOCK, self._size), self._dim), dtype=np.float32)
+        for start in range(0, self._size, QUANTIZED_SCORE_BLOCK):
+            block = self._matrix[start:min(start + QUANTIZED_SCORE_BLOCK, self._size)]
+            rows = buffer[:len(block)]
+            np.copyto(rows, block)
+            np.dot(rows, query, out=scores[start:start + len(block)])
+        return scores
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4, filter: Optional[dict] = None):
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        with self._lock:
+            if not self._size:
+                return []
+            scores = self._dot(query) * self._scales[:self._size]   # cosine similarity
+            if filter:
+                mask = np.fromiter((_matches(m, filter) for m in self._metadatas), dtype=bool, count=self._size)
+                scores = np.where(mask, scores, -np.inf)
+                candidates = int(mask.sum())
+            else:
+                candidates = self._size
+            k = min(k, candidates)
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(Document(page_content=self._texts[i], metadata=dict(self._metadatas[i])), float(scores[i]))
+                    for i in top]
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, filter: Optional[dict] = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs):
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs):
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k, filter)
+
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = ids or [str(len(self._ids) + i) for i in range(len(texts))]
+        self.upsert(ids, self._embedding.embed_documents(texts), texts, metadatas)
+        return ids
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, collection_name: str = "numpy", **kwargs):
+        store = cls(collection_name, embedding)
+        store.add_texts(texts, metadatas, kwargs.get("ids"))
+        return store